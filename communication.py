@@ -1,13 +1,35 @@
 import smtplib
 import imaplib
-import email
 import os
+import re
+import base64
+import quopri
+import itertools
+import sqlite3
+import threading
+import queue
+import atexit
+import time
+import importlib.util
 import pandas as pd
 from email.message import EmailMessage
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from urllib.parse import unquote, quote_from_bytes
 from dotenv import load_dotenv
 
 import mimetypes
 
+# python-calamine is optional (pip install python-calamine): it parses .xlsx
+# in native code. Without it pandas falls back to its default openpyxl engine.
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
+
+# imapclient is optional (pip install imapclient): it provides IMAP IDLE, so new
+# mail wakes the workflow up. Without it the workflow polls on a timer.
+try:
+    from imapclient import IMAPClient
+except ImportError:
+    IMAPClient = None
 
 
 
@@ -18,22 +40,80 @@ load_dotenv()
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
 
+IMAP_HOST = 'imap.gmail.com'
+# Maximum number of UIDs sent in a single FETCH command
+FETCH_BATCH = 100
+# Gmail search (X-GM-RAW) that lets the server drop emails without a spreadsheet
+GMAIL_SPREADSHEET_QUERY = '"has:attachment (filename:xlsx OR filename:xls)"'
+# Servers drop IDLE after 30 minutes of silence (RFC 2177), so it is renewed before that
+IDLE_TIMEOUT = 29 * 60
+
 PROCESSED_LOG_FILE = "processed_emails.txt"
+PROCESSED_DB_FILE = "processed_emails.db"
+LAST_UID_FILE = "last_uid.txt"
+
 
+_processed_db = None
+
+def get_processed_db():
+    """
+    Opens the SQLite store of processed email IDs (once per process).
+    When the database is first created, IDs from the old text log are imported.
+    """
+    global _processed_db
+    if _processed_db is None:
+        is_new = not os.path.exists(PROCESSED_DB_FILE)
+        conn = sqlite3.connect(PROCESSED_DB_FILE)
+        conn.execute("CREATE TABLE IF NOT EXISTS processed (message_id TEXT PRIMARY KEY)")
+        if is_new and os.path.exists(PROCESSED_LOG_FILE):
+            with open(PROCESSED_LOG_FILE, 'r') as f:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO processed VALUES (?)",
+                    ((line.strip(),) for line in f if line.strip())
+                )
+        conn.commit()
+        _processed_db = conn
+    return _processed_db
 
-def load_processed_ids():
-    """Loads the list of processed email IDs from a file."""
-    if not os.path.exists(PROCESSED_LOG_FILE):
-        return set()
-    with open(PROCESSED_LOG_FILE, 'r') as f:
-        return set(line.strip() for line in f if line.strip())
+def is_processed(message_id):
+    """Checks whether an email ID was already processed (indexed lookup, no file scan)."""
+    row = get_processed_db().execute(
+        "SELECT 1 FROM processed WHERE message_id = ?", (message_id,)
+    ).fetchone()
+    return row is not None
 
 def save_processed_id(message_id):
-    """Appends a new processed email ID to the file."""
+    """Records a new processed email ID."""
     if not message_id:
         return
-    with open(PROCESSED_LOG_FILE, 'a') as f:
-        f.write(f"{message_id}\n")
+    conn = get_processed_db()
+    conn.execute("INSERT OR IGNORE INTO processed VALUES (?)", (message_id,))
+    conn.commit()
+
+def load_last_uid(uidvalidity):
+    """
+    Loads the highest IMAP UID whose message has already been scanned (0 if none).
+    UIDs are only comparable within one UIDVALIDITY, so the watermark is discarded
+    when the mailbox reports a different one. A legacy file without it is trusted.
+    """
+    if not os.path.exists(LAST_UID_FILE):
+        return 0
+    with open(LAST_UID_FILE, 'r') as f:
+        fields = f.read().split()
+    if not fields:
+        return 0
+    if len(fields) == 2 and uidvalidity is not None and int(fields[0]) != uidvalidity:
+        print(" Mailbox UIDVALIDITY changed, rescanning recent emails.")
+        return 0
+    return int(fields[-1])
+
+def save_last_uid(uidvalidity, uid):
+    """Overwrites the scanned-UID watermark, tagged with the mailbox UIDVALIDITY."""
+    with open(LAST_UID_FILE, 'w') as f:
+        if uidvalidity is None:
+            f.write(f"{int(uid)}\n")
+        else:
+            f.write(f"{uidvalidity} {int(uid)}\n")
 
 # --- INTEGRATED PROCESSOR FUNCTIONS ---
 
@@ -47,7 +127,7 @@ def excel_reading(archive_path):
 
     try:
         # Read the Excel file using Pandas
-        df = pd.read_excel(archive_path)
+        df = pd.read_excel(archive_path, engine=EXCEL_ENGINE)
         # Cleanup: remove rows that are completely empty
         df = df.dropna(how='all')
         # Convert to a list of dictionaries
@@ -78,6 +158,10 @@ def send_custom_email(recipient_address, subject, message_body, attachment_path=
         print("Error: EMAIL_USER or EMAIL_PASS environment variables not set.")
         return False
 
+    return deliver_email(build_email(recipient_address, subject, message_body, attachment_path))
+
+def build_email(recipient_address, subject, message_body, attachment_path=None):
+    """Builds the EmailMessage for send_custom_email, reading the attachment into it right away."""
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['From'] = EMAIL_USER
@@ -114,6 +198,11 @@ def send_custom_email(recipient_address, subject, message_body, attachment_path=
     elif attachment_path:
         print(f"Warning: Attachment path '{attachment_path}' does not exist. Sending email without attachment.")
 
+    return msg
+
+def deliver_email(msg):
+    """Sends a built EmailMessage over SMTP. Returns True if it was sent."""
+    recipient_address = msg['To']
     try:
         with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
             smtp.login(EMAIL_USER, EMAIL_PASS)
@@ -124,79 +213,400 @@ def send_custom_email(recipient_address, subject, message_body, attachment_path=
         print(f"Error sending email: {e}")
         return False
 
+_email_queue = queue.Queue()
+_email_worker = None
+
+def send_email_async(recipient_address, subject, message_body, attachment_path=None):
+    """
+    Queues an email for send_custom_email on a background thread and returns at once,
+    so SMTP round-trips don't hold up the caller. Emails are sent in queue order.
+    The attachment is read now, so a later job overwriting the file can't change what is sent.
+    """
+    global _email_worker
+    if not EMAIL_USER or not EMAIL_PASS:
+        print("Error: EMAIL_USER or EMAIL_PASS environment variables not set.")
+        return
+
+    if _email_worker is None:
+        def work():
+            while True:
+                msg = _email_queue.get()
+                try:
+                    deliver_email(msg)
+                finally:
+                    _email_queue.task_done()
+
+        _email_worker = threading.Thread(target=work, daemon=True)
+        _email_worker.start()
+        # Send what is still queued before the interpreter exits, whatever the reason
+        atexit.register(flush_email_queue)
+
+    _email_queue.put(build_email(recipient_address, subject, message_body, attachment_path))
+
+def flush_email_queue():
+    """Blocks until every queued email has been handled."""
+    _email_queue.join()
+
+def uid_fetch(mail, uids, items):
+    """
+    Issues UID FETCH for many messages with as few commands as possible.
+    UIDs are sent in message sets of FETCH_BATCH, so a long backlog does not
+    exceed the server's maximum command length. Returns the combined response data.
+    """
+    data = []
+    for i in range(0, len(uids), FETCH_BATCH):
+        status, batch_data = mail.uid('FETCH', b','.join(uids[i:i + FETCH_BATCH]), items)
+        data.extend(batch_data)
+    return data
+
+def parse_fetch_response(data):
+    """
+    Maps each message in a multi-message IMAP FETCH response to its payload.
+    Literal payloads come back as (b'<num> (UID <uid> <item> {size}', payload) tuples;
+    they are keyed by UID when the response carries one, else by message number.
+    """
+    payloads = {}
+    for response_part in data:
+        if isinstance(response_part, tuple):
+            uid_match = re.search(rb'UID (\d+)', response_part[0])
+            num = uid_match.group(1) if uid_match else response_part[0].split()[0]
+            payloads[num] = response_part[1]
+    return payloads
+
+def group_fetch_response(data):
+    """
+    Joins every piece of a multi-message FETCH response into one bytes blob per UID.
+    Used for non-literal items like BODYSTRUCTURE, which imaplib splits around any
+    literals embedded in them (e.g. unusual filenames).
+    """
+    grouped = {}
+    uid = None
+    for response_part in data:
+        pieces = response_part if isinstance(response_part, tuple) else (response_part,)
+        start = re.match(rb'\d+ \(.*?UID (\d+)', pieces[0])
+        if start:
+            uid = start.group(1)
+            grouped[uid] = b''
+        if uid is not None:
+            grouped[uid] += b''.join(pieces)
+    return grouped
+
+IMAP_QUOTED_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+IMAP_ATOM_RE = re.compile(rb'[^ ()]+')
+
+def parse_imap_list(blob):
+    """
+    Parses the first parenthesized list of an IMAP response into nested Python lists.
+    Quoted strings and atoms become bytes, NIL becomes None and {n} literals are read inline.
+    """
+    def parse(pos):
+        items = []
+        pos += 1 # Skip the opening parenthesis
+        while True:
+            if pos >= len(blob):
+                raise ValueError("Unterminated list in IMAP response")
+            c = blob[pos:pos + 1]
+            if c == b')':
+                return items, pos + 1
+            if c == b' ':
+                pos += 1
+            elif c == b'(':
+                item, pos = parse(pos)
+                items.append(item)
+            elif c == b'"':
+                match = IMAP_QUOTED_RE.match(blob, pos)
+                items.append(re.sub(rb'\\(.)', rb'\1', match.group(1)))
+                pos = match.end()
+            elif c == b'{':
+                # group_fetch_response joins the literal right after its {size} marker
+                end = blob.index(b'}', pos)
+                size = int(blob[pos + 1:end])
+                items.append(blob[end + 1:end + 1 + size])
+                pos = end + 1 + size
+            else:
+                match = IMAP_ATOM_RE.match(blob, pos)
+                atom = match.group(0)
+                items.append(None if atom.upper() == b'NIL' else atom)
+                pos = match.end()
+
+    return parse(blob.index(b'('))[0]
+
+def decode_param(name, value):
+    """Decodes a MIME filename parameter, either RFC 2231 (name*) or RFC 2047 encoded."""
+    value = value.decode('utf-8', 'replace')
+    if name.endswith(b'*'):
+        # charset'language'percent-encoded-value
+        if value.count("'") < 2:
+            return unquote(value)
+        charset, _, encoded = value.split("'", 2)
+        return unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+    return str(make_header(decode_header(value)))
+
+def part_filename(params):
+    """
+    Returns the decoded filename (or, failing that, name) from a BODYSTRUCTURE parameter
+    list, including RFC 2231 continuations split over name*0*, name*1*, ... parameters.
+    """
+    pairs = [(name.lower(), value) for name, value in zip(params[::2], params[1::2]) if value]
+    for base in (b'filename', b'name'):
+        for name, value in pairs:
+            if name in (base, base + b'*'):
+                return decode_param(name, value)
+
+        segments = []
+        for name, value in pairs:
+            match = re.fullmatch(re.escape(base) + rb'\*(\d+)(\*?)', name)
+            if match:
+                segments.append((int(match.group(1)), match.group(2) == b'*', value))
+        if not segments:
+            continue
+        segments.sort()
+        if not any(encoded for _, encoded, _ in segments):
+            return decode_param(base, b''.join(value for _, _, value in segments))
+        # Percent-encode the plain segments too, so the joined value decodes in one go
+        joined = b''.join(value if encoded else quote_from_bytes(value).encode()
+                          for _, encoded, value in segments)
+        if not segments[0][1]:
+            joined = b"''" + joined # Only an encoded first segment carries the charset
+        return decode_param(base + b'*', joined)
+    return None
+
+def find_spreadsheet_part(structure, section=''):
+    """
+    Walks a parsed BODYSTRUCTURE and returns (section, filename, encoding) for the
+    first part with an .xlsx/.xls filename, or None if the message has none.
+    Attached emails (message/rfc822 parts) are searched too.
+    """
+    if isinstance(structure[0], list):
+        # Multipart: the sub-parts come first, followed by the subtype and extension data
+        children = itertools.takewhile(lambda item: isinstance(item, list), structure)
+        for i, child in enumerate(children, 1):
+            found = find_spreadsheet_part(child, f"{section}.{i}" if section else str(i))
+            if found:
+                return found
+        return None
+
+    # Single part: type, subtype, params, id, description, encoding, size, then
+    # type-specific fields before the extension data (md5, disposition, ...)
+    maintype, subtype = structure[0].lower(), structure[1].lower()
+    if maintype == b'text':
+        md5_index = 8
+    elif (maintype, subtype) == (b'message', b'rfc822'):
+        md5_index = 10
+    else:
+        md5_index = 7
+
+    params = list(structure[2] or [])
+    disposition = structure[md5_index + 1] if len(structure) > md5_index + 1 else None
+    if isinstance(disposition, list) and len(disposition) > 1 and disposition[1]:
+        params = list(disposition[1]) + params
+
+    filename = part_filename(params)
+    if filename and filename.lower().endswith(('.xlsx', '.xls')):
+        return section or '1', filename, (structure[5] or b'').lower()
+
+    if md5_index == 10 and isinstance(structure[8], list):
+        # The attached email's own body: a multipart's children are numbered under this
+        # part's section, a single-part body is its section's part 1
+        inner, base = structure[8], section or '1'
+        return find_spreadsheet_part(inner, base if isinstance(inner[0], list) else f"{base}.1")
+    return None
+
+def decode_part(payload, encoding):
+    """Undoes the transfer encoding advertised for a MIME part in its BODYSTRUCTURE."""
+    if encoding == b'base64':
+        return base64.b64decode(payload)
+    if encoding == b'quoted-printable':
+        return quopri.decodestring(payload)
+    return payload
+
+_mail = None
+_uidvalidity = None
+
+def get_mail():
+    """
+    Returns a logged-in IMAP connection with the inbox selected.
+    The connection from the previous poll is reused while it answers NOOP,
+    which skips the TLS handshake, login and SELECT on every poll.
+    """
+    global _mail, _uidvalidity
+    if _mail is not None:
+        try:
+            _mail.noop()
+            return _mail
+        except (imaplib.IMAP4.error, OSError):
+            # Covers IMAP4.abort: the server or network dropped the connection
+            _mail = None
+
+    mail = imaplib.IMAP4_SSL(IMAP_HOST, 993)
+    mail.login(EMAIL_USER, EMAIL_PASS)
+    mail.select("inbox")
+    typ, data = mail.response('UIDVALIDITY')
+    _uidvalidity = int(data[0]) if data and data[0] else None
+    _mail = mail
+    return mail
+
+def drop_mail():
+    """Closes the cached IMAP connection, if any, so the next poll reconnects."""
+    global _mail
+    if _mail is not None:
+        try:
+            _mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        _mail = None
+
+def connect_idle_client():
+    """Opens an imapclient connection with the inbox selected read-only, for IDLE."""
+    client = IMAPClient(IMAP_HOST, ssl=True)
+    client.login(EMAIL_USER, EMAIL_PASS)
+    client.select_folder("INBOX", readonly=True)
+    return client
+
+def start_mail_watcher():
+    """
+    Starts a daemon thread that keeps a second IMAP connection in IDLE and sets the
+    returned Event whenever the server announces new mail.
+    Returns None when IDLE is unavailable (no imapclient, or the server lacks the
+    capability), in which case the caller should keep polling.
+    """
+    if IMAPClient is None:
+        return None
+
+    try:
+        client = connect_idle_client()
+        if not client.has_capability('IDLE'):
+            client.logout()
+            return None
+    except Exception as e:
+        print(f"Could not start IMAP IDLE, falling back to polling: {e}")
+        return None
+
+    new_mail = threading.Event()
+
+    def watch(client):
+        while True:
+            try:
+                client.idle()
+                while True:
+                    responses = client.idle_check(timeout=IDLE_TIMEOUT)
+                    if any(len(r) > 1 and r[1] == b'EXISTS' for r in responses):
+                        new_mail.set()
+                    elif not responses:
+                        # Quiet for IDLE_TIMEOUT: renew the IDLE command
+                        client.idle_done()
+                        client.idle()
+            except Exception as e:
+                print(f"IMAP IDLE connection lost, reconnecting: {e}")
+                # Let the workflow check the inbox in case mail arrived meanwhile
+                new_mail.set()
+                time.sleep(10)
+                try:
+                    client = connect_idle_client()
+                except Exception:
+                    pass
+
+    threading.Thread(target=watch, args=(client,), daemon=True).start()
+    return new_mail
+
 def download_and_process_latest_spreadsheet():
     """
     Scans the inbox for emails with spreadsheets, downloads the most recent one
     that hasn't been processed yet, and returns the sender's email.
     """
-    host = 'imap.gmail.com'
-    if not os.path.exists('downloads'):
-        os.makedirs('downloads')
-
-    processed_ids = load_processed_ids()
+    os.makedirs('downloads', exist_ok=True)
 
     try:
-        mail = imaplib.IMAP4_SSL(host, 993)
-        mail.login(EMAIL_USER, EMAIL_PASS)
-        mail.select("inbox")
+        mail = get_mail()
+        last_uid = load_last_uid(_uidvalidity)
         
-        # Search for all emails
-        status, messages = mail.search(None, 'ALL')
-        mail_ids = messages[0].split()
+        # Only ask the server for messages newer than the last fully scanned one.
+        # "n:*" always matches the newest message, even when its UID is below n.
+        criteria = ['UID', f'{last_uid + 1}:*']
+        if 'X-GM-EXT-1' in mail.capabilities:
+            # On Gmail, also let the server skip emails that carry no spreadsheet
+            criteria += ['X-GM-RAW', GMAIL_SPREADSHEET_QUERY]
+        status, messages = mail.uid('SEARCH', None, *criteria)
+        mail_ids = [uid for uid in messages[0].split() if int(uid) > last_uid]
         
         if not mail_ids:
             # print("📭 No messages found in inbox.") # Optional: reduce log spam
             return None
 
-        # Analyze the most recent 5 emails in reverse order
-        for num in reversed(mail_ids[-2:]): 
-            # Fetch headers first to check Message-ID without downloading attachments
-            status, header_data = mail.fetch(num, '(BODY.PEEK[HEADER])')
-            
-            msg_header = email.message_from_bytes(header_data[0][1])
+        recent_ids = mail_ids[-2:]
+
+        # Fetch the Message-ID, sender and top-level type of every candidate in a single
+        # round-trip, without downloading the rest of the headers or the attachments
+        header_data = uid_fetch(mail, recent_ids, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID FROM CONTENT-TYPE CONTENT-DISPOSITION)])')
+        headers = parse_fetch_response(header_data)
+
+        # Analyze the most recent emails in reverse order.
+        # Only header blocks are fetched, so the full message parser isn't needed
+        header_parser = BytesHeaderParser()
+        pending = []
+        for num in reversed(recent_ids):
+            msg_header = header_parser.parsebytes(headers.get(num, b''))
             message_id = msg_header.get("Message-ID", "").strip()
             
-            if message_id in processed_ids:
+            if is_processed(message_id):
                 # print(f"Skipping already processed email: {message_id}")
                 continue
 
-            # If not processed, fetch the full body
-            status, data = mail.fetch(num, '(BODY.PEEK[])')
-            for response_part in data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    for part in msg.walk():
-                        if part.get_content_maintype() == 'multipart': continue
-                        if part.get('Content-Disposition') is None: continue
-                        
-                        filename = part.get_filename()
-                        if filename and filename.lower().endswith(('.xlsx', '.xls')):
-                            filepath = os.path.join('downloads', filename)
-                            
-                            print(f" Spreadsheet found: {filename}")
-                            with open(filepath, 'wb') as f:
-                                f.write(part.get_payload(decode=True))
-
-                            sender = msg.get("From")
-                            
-                            # Mark as processed immediately
-                            save_processed_id(message_id)
-                            
-                            # Log out before processing the data
-                            mail.close()
-                            mail.logout()
-                            
-                            # Return sender to trigger workflow
-                            return sender
-
-        mail.close()
-        mail.logout()
+            # A single-part message can only carry a spreadsheet as a top-level attachment
+            if msg_header.get_content_maintype() != 'multipart' and msg_header.get_content_disposition() != 'attachment':
+                continue
+
+            pending.append((num, message_id, msg_header.get("From")))
+
+        # Locate the spreadsheet part of each candidate from its MIME structure
+        attachments = {}
+        if pending:
+            structure_data = uid_fetch(mail, [num for num, _, _ in pending], '(BODYSTRUCTURE)')
+            for num, blob in group_fetch_response(structure_data).items():
+                try:
+                    fields = parse_imap_list(blob)
+                    part = find_spreadsheet_part(fields[fields.index(b'BODYSTRUCTURE') + 1])
+                except Exception as e:
+                    # A malformed structure only skips its own message, not the whole poll
+                    print(f"Skipping message {num.decode()}: unreadable BODYSTRUCTURE ({e})")
+                    continue
+                if part:
+                    attachments[num] = part
+
+        # Download only those parts; messages with the same section number share a FETCH
+        by_section = {}
+        for num, (section, _, _) in attachments.items():
+            by_section.setdefault(section, []).append(num)
+
+        payloads = {}
+        for section, nums in by_section.items():
+            payloads.update(parse_fetch_response(uid_fetch(mail, nums, f'(BODY.PEEK[{section}])')))
+
+        for num, message_id, sender in pending:
+            if num in payloads:
+                section, filename, encoding = attachments[num]
+                filepath = os.path.join('downloads', filename)
+                
+                print(f" Spreadsheet found: {filename}")
+                with open(filepath, 'wb') as f:
+                    f.write(decode_part(payloads[num], encoding))
+                
+                # Mark as processed immediately
+                save_processed_id(message_id)
+                
+                # Return sender to trigger workflow
+                return sender
+
+        # Every candidate was checked without finding a new spreadsheet
+        save_last_uid(_uidvalidity, int(recent_ids[-1]))
+
         # print(" No new spreadsheets found in recent emails.")
         return None
 
     except Exception as e:
         print(f"Critical error in workflow: {e}")
+        # Start from a fresh connection on the next poll
+        drop_mail()
         return None
 
 # --- INTEGRATED WORKFLOW TEST ---
@@ -1,11 +1,18 @@
 import time
-import glob
+import atexit
 import os
+import json
+import threading
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import shutil
 import traceback
-from communication import download_and_process_latest_spreadsheet, send_custom_email
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from communication import download_and_process_latest_spreadsheet, send_email_async, flush_email_queue, start_mail_watcher, EXCEL_ENGINE
 # Import the pipeline steps from your main script
 from video_assembly import run_content_generation, run_editor
 
@@ -14,17 +21,82 @@ DOWNLOADS_DIR = "downloads"
 IMAGE_INPUT_DIR = "image_input"
 VIDEO_INPUT_DIR = "video_input"
 OUTPUT_VIDEO = "final_story.mp4"
+MANIFEST_FILE = os.path.join(DOWNLOADS_DIR, ".manifest.json")
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB
+DOWNLOAD_TIMEOUT = 60 # Seconds to wait for a connection or for the next block of data
+IDLE_WAIT_TIMEOUT = 300 # Seconds between inbox checks when IDLE has been quiet
+
+# Spreadsheet columns used to build scenes, with the value used when a cell or column is empty
+SCENE_COLUMNS = {
+    'item_name': '',
+    'video_link': '',
+    'image_link': '',
+    'title': '',
+    'caption': '',
+    'video_hint': '',
+    'text_direction': 'left',
+    'effects_duration': 0.5,
+    'video_redo': False,
+    'tts': False,
+    'tts_redo': False,
+    'only_video': False,
+}
+
+# Each column is normalised to the type of its default
+SCENE_DTYPES = {col: type(default) for col, default in SCENE_COLUMNS.items()}
+
+# One session shared by the download threads, so connections to the same host are reused.
+# Connection errors and 5xx responses are retried with backoff before a download fails.
+http = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=DOWNLOAD_WORKERS * 2,
+    pool_maxsize=DOWNLOAD_WORKERS * 2,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+)
+http.mount('https://', http_adapter)
+http.mount('http://', http_adapter)
+atexit.register(http.close)
+
+# File ID in a Google Drive share link (.../file/d/<id>/view)
+_GDRIVE_RE = re.compile(r'/d/([a-zA-Z0-9_-]+)')
 
 def get_google_drive_direct_link(url):
     """Converts a Google Drive view link to a direct download link."""
-    if "drive.google.com" in url:
+    if url.startswith(('https://drive.google.com', 'http://drive.google.com')):
         # Extract ID
-        file_id_match = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
+        file_id_match = _GDRIVE_RE.search(url)
         if file_id_match:
             file_id = file_id_match.group(1)
             return f"https://drive.google.com/uc?export=download&id={file_id}"
     return url
 
+_manifest = None
+_manifest_lock = threading.Lock()
+
+def load_manifest():
+    """
+    Returns the download manifest, {url: {path, filename, etag, last_modified}},
+    reading it from disk on first use. Callers must hold _manifest_lock.
+    """
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST_FILE, 'r') as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+def record_download(url, entry):
+    """Stores the validators of a finished download so later runs can skip it if unchanged."""
+    with _manifest_lock:
+        manifest = load_manifest()
+        manifest[url] = entry
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        with open(MANIFEST_FILE, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
 def download_asset(url, folder, item_name):
     """
     Downloads a file from a URL to the specified folder.
@@ -34,8 +106,24 @@ def download_asset(url, folder, item_name):
         # Normalize URL (Handle Google Drive)
         direct_url = get_google_drive_direct_link(url)
         
+        # Revalidate a previous download of the same URL instead of transferring it again
+        with _manifest_lock:
+            cached = load_manifest().get(direct_url)
+        headers = {}
+        if (cached and os.path.dirname(cached['path']) == folder
+                and os.path.splitext(cached['filename'])[0] == item_name
+                and os.path.exists(cached['path'])):
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        
         print(f"  Downloading: {item_name} from {url[:30]}...")
-        response = requests.get(direct_url, stream=True)
+        response = http.get(direct_url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 304:
+            response.close()
+            print(f"  Unchanged since last download, reusing {cached['path']}")
+            return cached['path'], cached['filename']
         response.raise_for_status()
         
         # Determine Extension
@@ -53,10 +141,20 @@ def download_asset(url, folder, item_name):
         filename = f"{item_name}{ext}"
         file_path = os.path.join(folder, filename)
         
-        # Save
+        # Save, copying in large blocks in C instead of a Python loop over small chunks
+        response.raw.decode_content = True
         with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+            shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+        
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            record_download(direct_url, {
+                "path": file_path,
+                "filename": filename,
+                "etag": etag,
+                "last_modified": last_modified
+            })
                 
         return file_path, filename
     except Exception as e:
@@ -67,25 +165,33 @@ def prepare_pipeline_config(spreadsheet_path):
     """
     Reads the Excel file, downloads assets, and builds the config dictionary for main.py.
     """
-    df = pd.read_excel(spreadsheet_path)
+    # Only materialise the scene columns; headers are matched the same way they are normalised below
+    df = pd.read_excel(
+        spreadsheet_path,
+        engine=EXCEL_ENGINE,
+        usecols=lambda c: str(c).strip().lower() in SCENE_COLUMNS
+    )
     # Normalize headers
-    df.columns = [c.lower().strip() for c in df.columns]
+    df.columns = df.columns.str.strip().str.lower()
     
-    scenes_config = []
+    # Fill gaps and fix types once, column-wise, instead of converting every cell.
+    # Only the known columns are kept, so rows come out as lightweight namedtuples.
+    df = df.reindex(columns=list(SCENE_COLUMNS)).fillna(SCENE_COLUMNS).astype(SCENE_DTYPES)
+    
+    rows = []
     
-    for index, row in df.iterrows():
-        item_name = str(row.get('item_name', '')).strip()
-        if not item_name or item_name.lower() == 'nan':
+    for row in df.itertuples(index=False):
+        item_name = row.item_name.strip()
+        if not item_name:
             continue
             
         print(f"\nProcessing Row: {item_name}")
         
         # 1. Determine Download Source
-        video_link = str(row.get('video_link', '')) if not pd.isna(row.get('video_link')) else ''
-        image_link = str(row.get('image_link', '')) if not pd.isna(row.get('image_link')) else ''
-        only_video = bool(row.get('only_video', False))
+        video_link = row.video_link
+        image_link = row.image_link
+        only_video = row.only_video
         
-        local_path = None
         target_folder = IMAGE_INPUT_DIR
         is_video_asset = False
         
@@ -108,9 +214,28 @@ def prepare_pipeline_config(spreadsheet_path):
             download_url = image_link
             target_folder = IMAGE_INPUT_DIR
 
-        # 2. Download File
-        if download_url:
-            local_path, filename = download_asset(download_url, target_folder, item_name)
+        rows.append((row, item_name, download_url, target_folder, is_video_asset, only_video))
+
+    # 2. Download Files
+    # Downloads are independent and network-bound, so they run concurrently
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        downloads = [
+            executor.submit(download_asset, download_url, target_folder, item_name) if download_url else None
+            for _, item_name, download_url, target_folder, _, _ in rows
+        ]
+
+    # A failed download fails the job (and triggers the error email) instead of
+    # silently rendering without that scene
+    failed = [f"{item_name} ({download_url})"
+              for (_, item_name, download_url, _, _, _), download in zip(rows, downloads)
+              if download and download.result() is None]
+    if failed:
+        raise RuntimeError("Could not download the assets of: " + ", ".join(failed))
+
+    scenes_config = []
+    
+    for (row, item_name, download_url, target_folder, is_video_asset, only_video), download in zip(rows, downloads):
+        local_path, filename = download.result() if download else (None, None)
 
         print(local_path)
         print(filename)
@@ -118,14 +243,14 @@ def prepare_pipeline_config(spreadsheet_path):
         # 3. Build Scene Dictionary
         scene_data = {
             "item_name": filename,
-            "title": str(row.get('title', '')) if not pd.isna(row.get('title')) else "",
-            "caption": str(row.get('caption', '')) if not pd.isna(row.get('caption')) else "",
-            "video_hint": str(row.get('video_hint', '')) if not pd.isna(row.get('video_hint')) else "",
-            "text_direction": str(row.get('text_direction', 'left')),
-            "effects_duration": float(row.get('effects_duration', 0.5)),
-            "video_redo": bool(row.get('video_redo', False)),
-            "tts": bool(row.get('tts', False)),
-            "tts_redo": bool(row.get('tts_redo', False)),
+            "title": row.title,
+            "caption": row.caption,
+            "video_hint": row.video_hint,
+            "text_direction": row.text_direction,
+            "effects_duration": row.effects_duration,
+            "video_redo": row.video_redo,
+            "tts": row.tts,
+            "tts_redo": row.tts_redo,
             "only_video": only_video
         }
         
@@ -141,13 +266,42 @@ def prepare_pipeline_config(spreadsheet_path):
         
     return {"scenes": scenes_config, "final_filename": OUTPUT_VIDEO}
 
+def find_latest_spreadsheet(folder):
+    """
+    Returns (path, mtime) of the newest .xlsx file in folder, or (None, None).
+    Reads the directory with a single scandir instead of glob plus a getmtime per file.
+    """
+    latest_path, latest_mtime = None, None
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith('.xlsx') and not entry.name.startswith('.') and entry.is_file():
+                mtime = entry.stat().st_mtime
+                if latest_mtime is None or mtime > latest_mtime:
+                    latest_path, latest_mtime = entry.path, mtime
+    return latest_path, latest_mtime
+
+def render_in_subprocess(config_data):
+    """
+    Runs the video editor in a separate process and waits for it.
+    MoviePy's compositing doesn't hold this process' GIL against the mail watcher and
+    email threads, and the memory of every opened clip is released when the render ends.
+    """
+    # spawn rather than fork, since this process is already running threads
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pool.submit(run_editor, config_data).result()
+
 def run_workflow():
     print("Starting Continuous Automation Process... (Press Ctrl+C to stop)")
 
     # Ensure directories exist
-    for d in [DOWNLOADS_DIR, IMAGE_INPUT_DIR, VIDEO_INPUT_DIR]:
-        if not os.path.exists(d):
-            os.makedirs(d)
+    for d in (DOWNLOADS_DIR, IMAGE_INPUT_DIR, VIDEO_INPUT_DIR):
+        os.makedirs(d, exist_ok=True)
+
+    # mtime of the last spreadsheet handed to the pipeline
+    last_processed_mtime = None
+
+    # Set by IMAP IDLE when new mail arrives; None means the server can't push
+    new_mail = start_mail_watcher()
 
     while True:
         try:
@@ -158,20 +312,23 @@ def run_workflow():
             if client_email:
                 print(f"New file received from {client_email}")
 
-                # Step 2: Send Confirmation Email
-                send_custom_email(
+                # Step 2: Send Confirmation Email (in the background, so assets start downloading now)
+                send_email_async(
                     client_email,
                     "Confirmation: File Received",
                     "Hello! We received your spreadsheet. Downloading assets and starting video generation now."
                 )
 
                 # Find the downloaded file
-                archive_list = glob.glob(os.path.join(DOWNLOADS_DIR, "*.xlsx"))
-                if not archive_list:
+                spreadsheet_path, spreadsheet_mtime = find_latest_spreadsheet(DOWNLOADS_DIR)
+                if not spreadsheet_path:
                     print("Error: Success reported but no .xlsx file found.")
                     continue
+                if spreadsheet_mtime == last_processed_mtime:
+                    print("Error: Success reported but no new .xlsx file was written.")
+                    continue
                 
-                spreadsheet_path = max(archive_list, key=os.path.getmtime)
+                last_processed_mtime = spreadsheet_mtime
                 print(f"Reading file: {spreadsheet_path}")
 
                 try:
@@ -187,12 +344,12 @@ def run_workflow():
                     run_content_generation(config_data)
                     
                     print("--- Running Video Editor ---")
-                    run_editor(config_data)
+                    render_in_subprocess(config_data)
                     
                     # Step 5: Send Success Email
                     if os.path.exists(OUTPUT_VIDEO):
                         print("Sending success email with attachment...")
-                        send_custom_email(
+                        send_email_async(
                             client_email,
                             "Video Generation Complete",
                             "Your video has been successfully generated! Please see the attached file.",
@@ -211,17 +368,24 @@ def run_workflow():
                     traceback.print_exc()
                     
                     # Send Error Email
-                    send_custom_email(
+                    send_email_async(
                         client_email,
                         "Error in Video Generation",
                         f"We encountered an issue while processing your request:\n\n{str(process_error)}"
                     )
             
-            # Reduce CPU usage
-            time.sleep(10)
+            # Wait for new mail: pushed through IDLE when available, else poll every 10s.
+            # The timeout still checks the inbox now and then if a notification is missed.
+            if new_mail is not None:
+                new_mail.wait(timeout=IDLE_WAIT_TIMEOUT)
+                new_mail.clear()
+            else:
+                time.sleep(10)
 
         except KeyboardInterrupt:
             print("\nStopping automation.")
+            # Don't drop confirmation/result emails that are still queued
+            flush_email_queue()
             break
         except Exception as e:
             print(f"Unexpected loop error: {e}")
@@ -0,0 +1,49 @@
+import os
+import sys
+import types
+
+import pytest
+
+import video_assembly
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for d in (video_assembly.IMAGE_INPUT_DIR, video_assembly.VIDEO_INPUT_DIR,
+              video_assembly.GEN_VIDEO_DIR, video_assembly.GEN_AUDIO_DIR):
+        (tmp_path / d).mkdir()
+    return tmp_path
+
+
+def test_existing_generated_video_renders_without_source_image(workdir, monkeypatch):
+    # The scene's video was generated on an earlier run; its source image has since been removed
+    (workdir / video_assembly.GEN_VIDEO_DIR / "cat_video.mp4").write_bytes(b"video")
+
+    generated = []
+    fake_generation = types.ModuleType("video_generation")
+    fake_generation.generate_video_single = lambda **kwargs: generated.append(kwargs)
+    monkeypatch.setitem(sys.modules, "video_generation", fake_generation)
+
+    added = []
+    class FakeSequencer:
+        def __init__(self, output_width, output_height):
+            pass
+        def add_scenes(self, scenes):
+            added.extend(scenes)
+        def render(self, filename, fps):
+            pass
+    fake_editor = types.ModuleType("video_editor")
+    fake_editor.StorySequencer = FakeSequencer
+    fake_editor.probe_media = lambda path: (None, None, 0)
+    monkeypatch.setitem(sys.modules, "video_editor", fake_editor)
+
+    scene = {"item_name": "cat.png", "title": "", "tts": False, "only_video": False}
+    existing = {d: video_assembly.list_files(d) for d in (
+        video_assembly.GEN_VIDEO_DIR, video_assembly.GEN_AUDIO_DIR,
+        video_assembly.IMAGE_INPUT_DIR, video_assembly.VIDEO_INPUT_DIR)}
+    video_assembly.generate_scene_assets(0, scene, existing, {})
+    video_assembly.run_editor({"scenes": [scene]})
+
+    assert not generated
+    assert [s["video_path"] for s in added] == [os.path.join(video_assembly.GEN_VIDEO_DIR, "cat_video.mp4")]
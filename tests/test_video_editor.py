@@ -0,0 +1,62 @@
+import subprocess
+
+import numpy as np
+import pytest
+
+pytest.importorskip("moviepy")
+from moviepy import ColorClip, VideoFileClip, vfx
+from moviepy.config import FFMPEG_BINARY
+
+import video_editor
+
+
+def write_source(path, fps, duration, size=(128, 96)):
+    """Writes a lossless clip whose frames are flat colours that encode their index."""
+    n = int(fps * duration)
+    frames = np.zeros((n, size[1], size[0], 3), dtype=np.uint8)
+    index = np.arange(n)
+    frames[..., 0] = ((index % 32) * 8)[:, None, None]
+    frames[..., 1] = ((index // 32) * 8)[:, None, None]
+    subprocess.run([
+        FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+        '-s', f'{size[0]}x{size[1]}', '-r', str(fps), '-i', '-',
+        '-c:v', 'libx264', '-qp', '0', '-pix_fmt', 'yuv444p', str(path)
+    ], input=frames.tobytes(), check=True)
+
+
+def render(source, output, fps, moviepy):
+    compositor = video_editor.VideoCompositor(str(source), drop_audio=True)
+    compositor.apply_base_transitions(fade_in=1.0, fade_out=1.0)
+    if moviepy:
+        compositor.ffmpeg_overlays = None
+    compositor.render(str(output), fps=fps, hw_accel='none')
+    clip = VideoFileClip(str(output))
+    return np.array([frame.astype(int) for frame in clip.iter_frames()]), clip.duration
+
+
+@pytest.mark.parametrize("source_fps, output_fps, duration", [(24, 12, 12), (30, 24, 8.9)])
+def test_filter_graph_matches_moviepy_with_mismatched_fps(tmp_path, source_fps, output_fps, duration):
+    source = tmp_path / "source.mp4"
+    write_source(source, source_fps, duration)
+
+    ffmpeg_frames, ffmpeg_duration = render(source, tmp_path / "ffmpeg.mp4", output_fps, moviepy=False)
+    moviepy_frames, moviepy_duration = render(source, tmp_path / "moviepy.mp4", output_fps, moviepy=True)
+
+    assert len(ffmpeg_frames) == len(moviepy_frames) == int(duration * output_fps)
+    assert ffmpeg_duration == pytest.approx(moviepy_duration)
+    # Same source frame and fade level on every output frame, up to encoder rounding
+    assert np.abs(ffmpeg_frames - moviepy_frames).max() <= 8
+
+
+@pytest.mark.parametrize("effect, t, source_t", [(vfx.MultiplySpeed(2), 1.5, 1.0), (vfx.Loop(duration=6), 4.5, 1.5)])
+def test_timeline_opens_readers_at_the_source_time(tmp_path, effect, t, source_t):
+    source = tmp_path / "source.mp4"
+    write_source(source, 24, 2)
+    clip = VideoFileClip(str(source)).with_effects([effect]).with_start(1)
+    clip.reader.close()
+    timeline = video_editor.TimelineClip([ColorClip(clip.size, color=(0, 0, 0), duration=8), clip],
+                                         use_bgclip=True)
+
+    assert clip in timeline.playing_clips(t)
+    # Local 0.5 s is source 1.0 s at double speed, local 3.5 s is source 1.5 s on the second loop
+    assert clip.reader.pos == clip.reader.get_frame_number(source_t) + 1
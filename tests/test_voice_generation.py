@@ -0,0 +1,45 @@
+import io
+import subprocess
+
+import numpy as np
+import pytest
+
+sf = pytest.importorskip("soundfile")
+if 'MP3' not in sf.available_formats():
+    pytest.skip("libsndfile was built without MP3 support", allow_module_level=True)
+
+import voice_generation
+
+
+def make_mp3(seconds=0.5, frame_rate=44100):
+    t = np.arange(int(seconds * frame_rate)) / frame_rate
+    buf = io.BytesIO()
+    sf.write(buf, (0.3 * np.sin(2 * np.pi * 440 * t)).astype(np.float32), frame_rate, format='MP3')
+    return buf.getvalue()
+
+
+def test_soundfile_is_detected():
+    assert voice_generation.sf is not None
+
+
+def test_decode_mp3_uses_soundfile(monkeypatch):
+    def no_ffmpeg(*args, **kwargs):
+        raise AssertionError("ffmpeg should not be called when soundfile can decode")
+    monkeypatch.setattr(subprocess, "run", no_ffmpeg)
+
+    audio = voice_generation.decode_mp3(make_mp3())
+    assert (audio.frame_rate, audio.channels, audio.sample_width) == (44100, 1, 2)
+    assert 400 <= len(audio) <= 600
+    assert np.abs(np.frombuffer(audio.raw_data, dtype=np.int16)).max() > 1000
+
+
+def test_decode_mp3_falls_back_to_ffmpeg(monkeypatch):
+    calls = []
+    def fake_ffmpeg(command, **kwargs):
+        calls.append(command)
+        return subprocess.CompletedProcess(command, 0, stdout=bytes(4410 * 2), stderr=b"")
+    monkeypatch.setattr(subprocess, "run", fake_ffmpeg)
+
+    audio = voice_generation.decode_mp3(b"not an mp3 stream")
+    assert len(calls) == 1
+    assert len(audio) == 100
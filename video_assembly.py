@@ -3,26 +3,30 @@ import sys
 import json
 import argparse
 import shutil
-from moviepy import AudioFileClip, VideoFileClip
-import logging
+import pickle
+import hashlib
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# Import pandas for Excel support
+# mutagen is optional: it reads the MP3 length from its headers without spawning ffprobe/ffmpeg
 try:
-    import pandas as pd
+    from mutagen.mp3 import MP3
 except ImportError:
-    print("Error: 'pandas' and 'openpyxl' libraries are required for Excel support.")
-    print("Please install them: pip install pandas openpyxl")
-    sys.exit(1)
-
-# Import custom modules
-try:
-    from video_generation import generate_video_single, download_video
-    from voice_generation import generate_speech
-    from video_editor import StorySequencer
-except ImportError as e:
-    print(f"Error importing modules: {e}")
-    print("Please ensure 'video_generation.py', 'voice_generation.py', and 'video_editor.py' are in the current directory.")
-    sys.exit(1)
+    MP3 = None
+
+# pandas, MoviePy (through video_editor) and the API clients take seconds to import,
+# so they are imported by the functions that use them: 'edit' never loads the
+# generation clients, and a cached spreadsheet never loads pandas.
+
+def import_pipeline_module(name):
+    """Imports one of the custom pipeline modules, or exits with a hint if it can't be loaded."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        print(f"Error importing modules: {e}")
+        print("Please ensure 'video_generation.py', 'voice_generation.py', and 'video_editor.py' are in the current directory.")
+        sys.exit(1)
 
 # --- Configuration Constants ---
 IMAGE_INPUT_DIR = "image_input"
@@ -31,6 +35,30 @@ GEN_VIDEO_DIR = "generated_videos"
 GEN_AUDIO_DIR = "generated_audio"
 DEFAULT_RES = [1280, 720]
 DEFAULT_FILENAME = "final_story.mp4"
+DURATIONS_FILE = os.path.join(GEN_AUDIO_DIR, ".durations.json")
+CONFIG_CACHE_DIR = ".cache"
+SCENE_WORKERS = 4 # Scenes generated concurrently, kept low for the API rate limits
+# Spreadsheet columns the pipeline reads, any other column is not parsed
+CONFIG_COLUMNS = ('item_name', 'title', 'caption', 'tts', 'tts_redo', 'video_redo',
+                  'only_video', 'video_hint', 'effects_duration', 'text_direction')
+
+def normalize_flags(column):
+    """
+    Converts a spreadsheet flag column to bool.
+    Handles Excel True/False/1/0/"True": text cells are true when they read
+    'true', '1' or 'yes', any other cell by its truthiness.
+    """
+    import pandas as pd
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(column):
+        return column.astype(bool)
+    # .str yields NaN for the cells that aren't text
+    text = column.str.lower()
+    return text.isin(['true', '1', 'yes']).where(text.notna(), column.astype(bool)).astype(bool)
+
+def config_cache_path(config_path):
+    """Returns the pickle file that caches the parsed scenes of a spreadsheet."""
+    key = hashlib.sha1(os.path.abspath(config_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CONFIG_CACHE_DIR, f"config_{key}.pkl")
 
 def load_config(config_path):
     """
@@ -48,27 +76,56 @@ def load_config(config_path):
             return json.load(f)
             
     elif ext in ['.xlsx', '.xls']:
+        # Reuse the parse of a previous run while the spreadsheet is unchanged
+        stat = os.stat(config_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cache_path = config_cache_path(config_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_signature, cached_config = pickle.load(f)
+            if cached_signature == signature:
+                return cached_config
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+
+        try:
+            import pandas as pd
+        except ImportError:
+            print("Error: 'pandas' and 'openpyxl' libraries are required for Excel support.")
+            print("Please install them: pip install pandas openpyxl")
+            print("Optionally add python-calamine for faster spreadsheet parsing: pip install python-calamine")
+            sys.exit(1)
+        from communication import EXCEL_ENGINE
+
         try:
-            df = pd.read_excel(config_path)
+            # openpyxl fallback: stream rows in read-only mode (pandas' default, made explicit)
+            engine_options = {} if EXCEL_ENGINE else {
+                "engine_kwargs": {"read_only": True, "data_only": True, "keep_links": False}
+            }
+            df = pd.read_excel(config_path, engine=EXCEL_ENGINE,
+                               usecols=lambda c: c in CONFIG_COLUMNS, **engine_options)
             # Fill NaN values with empty strings or False for booleans
             df = df.fillna("")
             
+            # Normalize boolean columns, a whole column at a time
+            bool_cols = ['video_redo', 'only_video', 'tts', 'tts_redo']
+            for col in bool_cols:
+                if col in df.columns:
+                    df[col] = normalize_flags(df[col])
+            
             # Convert to list of dicts
             scenes = df.to_dict('records')
-            
-            # Normalize boolean columns
-            bool_cols = ['video_redo', 'only_video', 'tts', 'tts_redo']
+            # Stored with the scenes, so the pickle cache keeps them too
             for scene in scenes:
-                for col in bool_cols:
-                    if col in scene:
-                        val = scene[col]
-                        # Handle Excel True/False/1/0/"True"
-                        if isinstance(val, str):
-                            scene[col] = val.lower() in ['true', '1', 'yes']
-                        else:
-                            scene[col] = bool(val)
+                if scene.get("item_name"):
+                    asset_names(scene)
+            config = {"scenes": scenes}
+            
+            os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+            with open(cache_path, 'wb') as f:
+                pickle.dump((signature, config), f, protocol=pickle.HIGHEST_PROTOCOL)
                             
-            return {"scenes": scenes}
+            return config
         except Exception as e:
             print(f"Error reading Excel file: {e}")
             sys.exit(1)
@@ -76,126 +133,252 @@ def load_config(config_path):
         print("Unsupported file format. Use .json or .xlsx")
         sys.exit(1)
 
-def run_content_generation(config):
-    """Step 1: Generates Audio and Video assets based on flags."""
-    print("\n=== STEP 1: Content Generation & Validation ===")
-    
-    scenes = config.get("scenes", [])
+def asset_names(scene):
+    """
+    Returns the (audio, video) file names generated for a scene, derived from its item_name.
+    Computed once and kept on the scene, since both pipeline steps need them.
+    """
+    names = scene.get("_asset_names")
+    if names is None:
+        base_name = os.path.splitext(scene["item_name"])[0]
+        names = scene["_asset_names"] = (f"{base_name}_audio.mp3", f"{base_name}_video.mp4")
+    return names
+
+def list_files(folder):
+    """Returns the names of the entries in folder as a set, with a single scandir call."""
+    try:
+        with os.scandir(folder) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+_durations_lock = threading.Lock()
+
+def _load_durations():
+    try:
+        with open(DURATIONS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    print("Config: ", config)
+def get_audio_duration(audio_path):
+    """
+    Returns the duration of an audio file in seconds.
+    Durations are cached in DURATIONS_FILE with the file's mtime, so
+    unchanged files are not probed again on later runs.
+    """
+    # Scenes run in parallel, so the cache file is only read and written under the lock,
+    # while the probe itself runs outside it
+    mtime = os.path.getmtime(audio_path)
+    with _durations_lock:
+        cached = _load_durations().get(audio_path)
+    if cached and cached["mtime"] == mtime:
+        return cached["duration"]
+
+    if MP3 is not None:
+        duration = MP3(audio_path).info.length
+    else:
+        from video_editor import probe_media
+        duration = probe_media(audio_path)[2]
 
-    print("SceneS: ", scenes)
-    
-    # Ensure directories exist
-    for d in [GEN_VIDEO_DIR, GEN_AUDIO_DIR, IMAGE_INPUT_DIR, VIDEO_INPUT_DIR]:
-        if not os.path.exists(d):
-            os.makedirs(d)
+    with _durations_lock:
+        # Re-read, so entries written by other scenes during the probe are kept
+        durations = _load_durations()
+        durations[audio_path] = {"mtime": mtime, "duration": duration}
+        with open(DURATIONS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(durations, f, indent=2)
+    return duration
 
-    print(GEN_AUDIO_DIR)
-    
-    for i, scene in enumerate(scenes):
-        item_name = scene.get("item_name")
-        if not item_name:
-            print(f"Skipping row {i+1}: Missing 'item_name'.")
-            continue
+_speech_lock = threading.Lock()
 
-        print("scene: ", scene)
+def generate_speech_once(text, audio_path, speech_paths, redo=False):
+    """
+    Calls generate_speech, but when the same text was already spoken in this run
+    the earlier file is copied to audio_path instead of calling the API again.
+    speech_paths maps each text spoken so far to its file and belongs to a single run.
+    With redo, both that reuse and generate_speech's on-disk cache are skipped.
+    """
+    with _speech_lock:
+        source = None if redo else speech_paths.get(text)
+    if source and os.path.exists(source):
+        print(f"  [Audio] Same text as {source}, reusing it.")
+        shutil.copyfile(source, audio_path)
+        return True
+
+    from voice_generation import generate_speech
+    success = generate_speech(text, audio_path, use_cache=not redo)
+    if success:
+        with _speech_lock:
+            speech_paths.setdefault(text, audio_path)
+    return success
+
+def generate_scene_assets(i, scene, existing, speech_paths):
+    """
+    Generates the audio and video assets of a single scene (row i of the config).
+    existing maps each asset folder to the set of file names it held at the start of the run.
+    speech_paths is the run's text -> audio file map shared with generate_speech_once.
+    """
+    from video_generation import generate_video_single
+    from video_editor import probe_media
 
-        base_name = os.path.splitext(item_name)[0]
-        print(f"\nProcessing Item: {item_name}")
+    item_name = scene.get("item_name")
+    if not item_name:
+        print(f"Skipping row {i+1}: Missing 'item_name'.")
+        return
 
-        # --- 1. Audio Generation Logic ---
-        audio_duration = 0
-        audio_path = None
+    print("scene: ", scene)
 
-        print("TTS?", scene.get('tts'))
+    # Asset paths found on disk are recorded on the scene for run_editor
+    scene["_resolved_video_path"] = None
+    scene["_resolved_audio_path"] = None
 
+    audio_filename, target_video_name = asset_names(scene)
+    print(f"\nProcessing Item: {item_name}")
 
+    # --- 1. Audio Generation Logic ---
+    audio_duration = 0
+    audio_path = None
+
+    print("TTS?", scene.get('tts'))
+
+
+    
+    should_tts = scene.get("tts", False)
+    print("should tts?", should_tts)
+    title_text = scene.get("title", "").strip()
+    
+    if should_tts and title_text:
+        print("audio file: ", audio_filename)
+        audio_path = os.path.join(GEN_AUDIO_DIR, audio_filename)
         
-        should_tts = scene.get("tts", False)
-        print("should tts?", should_tts)
-        title_text = scene.get("title", "").strip()
+        has_audio = audio_filename in existing[GEN_AUDIO_DIR]
         
-        if should_tts and title_text:
-            audio_filename = f"{base_name}_audio.mp3"
-            print("base name: ", base_name)
-            audio_path = os.path.join(GEN_AUDIO_DIR, audio_filename)
-            
-            # Check Redo Flag
-            if scene.get("tts_redo", False) and os.path.exists(audio_path):
-                print(f"  [Audio] Redo requested. Removing old file.")
-                os.remove(audio_path)
-            
-            if not os.path.exists(audio_path):
-                print(f"  [Audio] Generating speech...")
-                success = generate_speech(title_text, audio_path)
-                print(success)
-                if not success:
-                    print("  [Error] Audio generation failed.")
-            else:
-                print(f"  [Audio] Found existing file.")
-            
-            # Get Duration
-            if os.path.exists(audio_path):
-                try:
-                    with AudioFileClip(audio_path) as clip:
-                        audio_duration = clip.duration
-                except Exception as e:
-                    print(f"  [Error] Could not measure audio: {e}")
-        elif should_tts and not title_text:
-            print("  [Audio] TTS is True but 'title' is empty. Skipping.")
-
-        # --- 2. Video Logic ---
-        only_video = scene.get("only_video", False)
+        # Check Redo Flag
+        tts_redo = scene.get("tts_redo", False)
+        if tts_redo and has_audio:
+            print(f"  [Audio] Redo requested. Removing old file.")
+            os.remove(audio_path)
+            has_audio = False
         
-        if only_video:
-            # --- Case A: User Provided Video ---
-            source_video = os.path.join(VIDEO_INPUT_DIR, item_name)
-            if not os.path.exists(source_video):
-                print(f"  [Error] only_video=True but file not found: {source_video}")
-                continue
-                
-            # Validation: Audio longer than Video?
-            if audio_duration > 0:
-                try:
-                    with VideoFileClip(source_video) as clip:
-                        vid_duration = clip.duration
-                    
-                    if audio_duration > vid_duration:
-                        print(f"  [CRITICAL ERROR] Audio ({audio_duration:.2f}s) is longer than input video ({vid_duration:.2f}s).")
-                        print("  Stopping execution as requested.")
-                        sys.exit(1) 
-                except Exception as e:
-                    print(f"  [Error] Could not validate video duration: {e}")
-
+        if not has_audio:
+            print(f"  [Audio] Generating speech...")
+            success = generate_speech_once(title_text, audio_path, speech_paths, redo=tts_redo)
+            print(success)
+            if not success:
+                print("  [Error] Audio generation failed.")
         else:
-            # --- Case B: AI Generation ---
-            source_image = os.path.join(IMAGE_INPUT_DIR, item_name)
-            if not os.path.exists(source_image):
-                print(f"  [Warning] Source image not found: {source_image}")
-                continue
-                
-            target_video_path = os.path.join(GEN_VIDEO_DIR, f"{base_name}_video.mp4")
+            print(f"  [Audio] Found existing file.")
+        
+        # Get Duration
+        if os.path.exists(audio_path):
+            scene["_resolved_audio_path"] = audio_path
+            try:
+                audio_duration = get_audio_duration(audio_path)
+            except Exception as e:
+                print(f"  [Error] Could not measure audio: {e}")
+    elif should_tts and not title_text:
+        print("  [Audio] TTS is True but 'title' is empty. Skipping.")
+
+    # --- 2. Video Logic ---
+    only_video = scene.get("only_video", False)
+    
+    if only_video:
+        # --- Case A: User Provided Video ---
+        source_video = os.path.join(VIDEO_INPUT_DIR, item_name)
+        if item_name not in existing[VIDEO_INPUT_DIR]:
+            print(f"  [Error] only_video=True but file not found: {source_video}")
+            return
             
-            # Check Redo Flag
-            if scene.get("video_redo", False) and os.path.exists(target_video_path):
-                print(f"  [Video] Redo requested. Removing old file.")
-                os.remove(target_video_path)
+        # Validation: Audio longer than Video?
+        if audio_duration > 0:
+            try:
+                vid_duration = probe_media(source_video)[2]
                 
-            if not os.path.exists(target_video_path):
-                # Calculate Duration: Audio + 1s (min 5s fallback if no audio)
-                calc_duration = int(audio_duration) + 1 if audio_duration > 0 else 5
-                
-                print(f"  [Video] Generating AI Video (Duration: {calc_duration}s)...")
-                generate_video_single(
-                    image_path=source_image,
-                    prompt=scene.get("video_hint", ""),
-                    duration=calc_duration,
-                    output_path=target_video_path,
-                    model_endpoint="fal-ai/vidu/q3/image-to-video"
-                )
-            else:
-                print(f"  [Video] Found existing generated video.")
+                if audio_duration > vid_duration:
+                    print(f"  [CRITICAL ERROR] Audio ({audio_duration:.2f}s) is longer than input video ({vid_duration:.2f}s).")
+                    print("  Stopping execution as requested.")
+                    sys.exit(1) 
+            except Exception as e:
+                print(f"  [Error] Could not validate video duration: {e}")
+
+        scene["_resolved_video_path"] = source_video
+
+    else:
+        # --- Case B: AI Generation ---
+        source_image = os.path.join(IMAGE_INPUT_DIR, item_name)
+        target_video_path = os.path.join(GEN_VIDEO_DIR, target_video_name)
+        has_video = target_video_name in existing[GEN_VIDEO_DIR]
+        if has_video:
+            # A video generated earlier still renders, even once its source image is gone
+            scene["_resolved_video_path"] = target_video_path
+
+        if item_name not in existing[IMAGE_INPUT_DIR]:
+            print(f"  [Warning] Source image not found: {source_image}")
+            return
+        
+        # Check Redo Flag
+        video_redo = scene.get("video_redo", False)
+        if video_redo and has_video:
+            print(f"  [Video] Redo requested. Removing old file.")
+            os.remove(target_video_path)
+            has_video = False
+            
+        if not has_video:
+            # Calculate Duration: Audio + 1s (min 5s fallback if no audio)
+            calc_duration = int(audio_duration) + 1 if audio_duration > 0 else 5
+            
+            print(f"  [Video] Generating AI Video (Duration: {calc_duration}s)...")
+            generate_video_single(
+                image_path=source_image,
+                prompt=scene.get("video_hint", ""),
+                duration=calc_duration,
+                output_path=target_video_path,
+                model_endpoint="fal-ai/vidu/q3/image-to-video",
+                redo=video_redo
+            )
+        else:
+            print(f"  [Video] Found existing generated video.")
+
+        if has_video or os.path.exists(target_video_path):
+            scene["_resolved_video_path"] = target_video_path
+
+def run_content_generation(config):
+    """Step 1: Generates Audio and Video assets based on flags."""
+    print("\n=== STEP 1: Content Generation & Validation ===")
+    
+    scenes = config.get("scenes", [])
+
+    print("Config: ", config)
+
+    print("SceneS: ", scenes)
+    
+    # Ensure directories exist
+    for d in (GEN_VIDEO_DIR, GEN_AUDIO_DIR, IMAGE_INPUT_DIR, VIDEO_INPUT_DIR):
+        os.makedirs(d, exist_ok=True)
+
+    print(GEN_AUDIO_DIR)
+
+    # Loaded here, before the workers start, so a missing module is reported once
+    for name in ("video_generation", "voice_generation", "video_editor"):
+        import_pipeline_module(name)
+    
+    # One directory listing per folder instead of a stat per scene and file
+    existing = {d: list_files(d) for d in [GEN_VIDEO_DIR, GEN_AUDIO_DIR, IMAGE_INPUT_DIR, VIDEO_INPUT_DIR]}
+    
+    # Audio generated in this run, so scenes repeating a text share one TTS call
+    speech_paths = {}
+    
+    # Scenes are independent and spend their time waiting on the TTS and video APIs,
+    # so up to SCENE_WORKERS of them are generated at once
+    with ThreadPoolExecutor(max_workers=SCENE_WORKERS) as executor:
+        futures = [executor.submit(generate_scene_assets, i, scene, existing, speech_paths) for i, scene in enumerate(scenes)]
+        try:
+            for future in futures:
+                future.result()
+        except SystemExit:
+            # A scene failed validation: don't start the scenes still queued
+            executor.shutdown(cancel_futures=True)
+            raise
 
 def run_editor(config):
     """Step 2: Assembles the final video."""
@@ -206,36 +389,54 @@ def run_editor(config):
     final_filename = config.get("final_filename", DEFAULT_FILENAME)
     scenes = config.get("scenes", [])
     
+    StorySequencer = import_pipeline_module("video_editor").StorySequencer
     sequencer = StorySequencer(output_width=output_res[0], output_height=output_res[1])
 
     print(f"Scenes: {scenes}")
 
     
-    scenes_added = 0
+    pending = []
+
+    # Folder listings, only needed for scenes that run_content_generation didn't resolve
+    # in this run (e.g. the "edit" action on its own)
+    listings = None
 
     for i, scene in enumerate(scenes):
         item_name = scene.get("item_name")
         if not item_name: continue
         
-        base_name = os.path.splitext(item_name)[0]
-        only_video = scene.get("only_video", False)
-        
-        # 1. Resolve Video Path
-        if only_video:
-            video_path = os.path.join(VIDEO_INPUT_DIR, item_name)
+        if "_resolved_video_path" in scene:
+            # 1-2. Paths already checked on disk during content generation
+            video_path = scene["_resolved_video_path"]
+            audio_path = scene["_resolved_audio_path"]
+            if not video_path:
+                print(f"[Skipping] Video not found for: {item_name}")
+                continue
         else:
-            video_path = os.path.join(GEN_VIDEO_DIR, f"{base_name}_video.mp4")
+            if listings is None:
+                # One directory listing per folder instead of a stat per scene and file
+                listings = {d: list_files(d) for d in [VIDEO_INPUT_DIR, GEN_VIDEO_DIR, GEN_AUDIO_DIR]}
+            
+            audio_filename, video_filename = asset_names(scene)
+            only_video = scene.get("only_video", False)
             
-        if not os.path.exists(video_path):
-            print(f"[Skipping] Video not found: {video_path}")
-            continue
+            # 1. Resolve Video Path
+            if only_video:
+                video_path = os.path.join(VIDEO_INPUT_DIR, item_name)
+                video_exists = item_name in listings[VIDEO_INPUT_DIR]
+            else:
+                video_path = os.path.join(GEN_VIDEO_DIR, video_filename)
+                video_exists = video_filename in listings[GEN_VIDEO_DIR]
+                
+            if not video_exists:
+                print(f"[Skipping] Video not found: {video_path}")
+                continue
 
-        # 2. Resolve Audio Path
-        audio_path = None
-        if scene.get("tts", False):
-            cand_path = os.path.join(GEN_AUDIO_DIR, f"{base_name}_audio.mp3")
-            if os.path.exists(cand_path):
-                audio_path = cand_path
+            # 2. Resolve Audio Path
+            audio_path = None
+            if scene.get("tts", False):
+                if audio_filename in listings[GEN_AUDIO_DIR]:
+                    audio_path = os.path.join(GEN_AUDIO_DIR, audio_filename)
 
         print(audio_path)
 
@@ -246,17 +447,19 @@ def run_editor(config):
         # Logic: If both empty, pass empty strings (Sequencer handles "no black bar" logic)
         # Note: Sequencer.create_sidebar_clip checks `if title or caption`.
         
-        # 4. Add to Sequencer
         print(f"Adding scene: {item_name}")
-        sequencer.add_scene(
+        pending.append(dict(
             video_path=video_path,
             title=title,
             caption=caption,
             effects_duration=float(scene.get("effects_duration", 0.5)),
             text_direction=scene.get("text_direction", "left"),
             audio_path=audio_path
-        )
-        scenes_added += 1
+        ))
+
+    # 4. Add to Sequencer (prepares the scenes in parallel)
+    sequencer.add_scenes(pending)
+    scenes_added = len(pending)
 
     if scenes_added > 0:
         print(f"Rendering {scenes_added} scenes to {final_filename}...")
@@ -285,7 +488,17 @@ if __name__ == "__main__":
         help="Path to .xlsx (Excel) or .json config file."
     )
 
+    parser.add_argument(
+        "--hw-accel",
+        choices=["auto", "none", "cuda", "qsv", "videotoolbox"],
+        default=os.environ.get("HW_ACCEL", "auto"),
+        help="'auto': encode with a hardware H.264 encoder when one works. 'none': always libx264. "
+             "'cuda', 'qsv', 'videotoolbox': only try NVENC, Quick Sync or VideoToolbox."
+    )
+
     args = parser.parse_args()
+    # Read by video_editor when it's imported (also in the render subprocess)
+    os.environ["HW_ACCEL"] = args.hw_accel
 
     # Environment Check
     if args.action in ["video", "all"]:
@@ -1,17 +1,54 @@
 import os
-import textwrap
+import re
+import json
+import functools
 import math
+import queue
+import threading
+import subprocess
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 from moviepy import (
+    VideoClip,
     VideoFileClip, 
     ImageClip, 
-    TextClip, 
     CompositeVideoClip, 
     ColorClip, 
     AudioFileClip,
-    concatenate_videoclips,
     vfx
 )
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+# Composited frames waiting to be encoded; bounds the memory used by the render pipeline
+FRAME_QUEUE_SIZE = 8
+# Scenes prepared concurrently by StorySequencer.add_scenes (each starts its own ffmpeg reader)
+SCENE_PREP_WORKERS = 8
+# Processes rendering a story, each one composites and encodes a stretch of the timeline
+RENDER_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+MIN_SEGMENT_SECONDS = 10 # Shorter stories (or stretches) are not worth a process of their own
+
+# Hardware H.264 encoders in order of preference, with their preset (None: no preset option)
+HW_ENCODERS = (('h264_nvenc', 'p4'), ('h264_qsv', 'medium'), ('h264_videotoolbox', None))
+HW_BITRATE = "5M"
+# ffmpeg -hwaccel decoder that goes with each hardware encoder, on the same device
+HW_DECODERS = {'h264_nvenc': 'cuda', 'h264_qsv': 'qsv', 'h264_videotoolbox': 'videotoolbox'}
+# Names that pin HW_ACCEL to one of the encoders above
+HW_BACKENDS = {'cuda': 'h264_nvenc', 'qsv': 'h264_qsv', 'videotoolbox': 'h264_videotoolbox'}
+# 'auto' uses the first hardware encoder that works on this machine, 'none' always uses libx264,
+# a HW_BACKENDS name only tries that encoder (and falls back to libx264)
+HW_ACCEL = os.environ.get("HW_ACCEL", "auto")
+# libx264 defaults: much faster than its 'medium' preset for a slightly larger file
+X264_PRESET = "veryfast"
+X264_CRF = 23
+
+# ffmpeg scaler used when opening scene videos at the output size, by quality
+RESIZE_ALGORITHMS = {'best': 'lanczos', 'fast': 'bilinear'}
 
 # Helpers before main functionality
 # Cropping function
@@ -27,19 +64,39 @@ def resize_and_crop(clip, target_w, target_h):
     if h == 0 or target_h == 0:
         return clip
 
-    target_ratio = target_w / target_h
-    current_ratio = w / h
-    
-    if current_ratio > target_ratio:
-        # Resize based on Height to fill vertically, then crop width.
-        new_clip = clip.resized(height=target_h)
-    else:
-        # Resize based on Width to fill horizontally, then crop height.
-        new_clip = clip.resized(width=target_w)
-        
+    # Resize based on Height or Width so the clip fills the target, then crop the rest
+    new_clip = clip.resized(fill_size(w, h, target_w, target_h))
+
     # Center crop to exact target dimensions
     return new_clip.cropped(width=target_w, height=target_h, x_center=new_clip.w / 2, y_center=new_clip.h / 2)
 
+def fill_size(w, h, target_w, target_h):
+    """Size the clip has to be scaled to so it fills the target, keeping its aspect ratio."""
+    if w / h > target_w / target_h:
+        return int(w * target_h / h), target_h
+    return target_w, int(h * target_w / w)
+
+def open_video_filled(video_path, target_w, target_h, quality='best'):
+    """
+    Opens a video already scaled to fill the target dimensions, then center crops the excess
+    like resize_and_crop. The scaling is done by the ffmpeg process decoding the video
+    instead of a Pillow Lanczos pass per frame in Python. quality 'fast' (bilinear) is
+    meant for previews.
+    """
+    infos = ffmpeg_parse_infos(video_path)
+    w, h = infos.get('video_size') or (target_w, target_h)
+    if abs(infos.get('video_rotation', 0)) in (90, 270):
+        w, h = h, w
+    if h == 0 or target_h == 0:
+        return VideoFileClip(video_path)
+
+    new_w, new_h = fill_size(w, h, target_w, target_h)
+    clip = VideoFileClip(video_path, target_resolution=(new_w, new_h),
+                         resize_algorithm=RESIZE_ALGORITHMS[quality])
+    if (new_w, new_h) == (target_w, target_h):
+        return clip
+    return clip.cropped(width=target_w, height=target_h, x_center=new_w / 2, y_center=new_h / 2)
+
 def create_gradient_bar(width, height, direction='left', color=(0,0,0), max_opacity=0.8):
     """
     Creates a gradient bar (RGBA) for text background using numpy.
@@ -50,66 +107,103 @@ def create_gradient_bar(width, height, direction='left', color=(0,0,0), max_opac
     if w <= 0 or h <= 0:
         return ColorClip(size=(max(1, w), max(1, h)), color=(0,0,0,0))
 
+    return ImageClip(gradient_array(w, h, direction, tuple(color), max_opacity))
+
+@functools.lru_cache(maxsize=32)
+def gradient_array(w, h, direction, color, max_opacity):
+    """
+    Builds the RGBA pixels of a gradient bar. Cached, since every scene of a story
+    usually has a sidebar of the same size; the array is read-only as it is shared.
+    """
+    # One uint8 buffer: the colour is broadcast into RGB and a 1-D ramp into alpha,
+    # instead of building full-size float/int planes and stacking them
+    img_array = np.empty((h, w, 4), dtype=np.uint8)
+    img_array[..., :3] = color[:3]
+
     if direction in ['left', 'right']:
         x = np.linspace(0, 1, w)
-        if direction == 'left':
-            alpha_row = (1 - x) * 255 * max_opacity
-        else: # right
-            alpha_row = x * 255 * max_opacity
-            
-        alpha_row = alpha_row.reshape(1, w)
-        alpha = np.tile(alpha_row, (h, 1))
+        ramp = (1 - x) if direction == 'left' else x
+        img_array[..., 3] = (ramp * 255 * max_opacity).astype(np.uint8)[None, :]
     else:
         y = np.linspace(0, 1, h)
-        if direction == 'top':
-            alpha_col = (1 - y) * 255 * max_opacity
-        else: # bottom
-            alpha_col = y * 255 * max_opacity
-            
-        alpha_col = alpha_col.reshape(h, 1)
-        alpha = np.tile(alpha_col, (1, w))
+        ramp = (1 - y) if direction == 'top' else y
+        img_array[..., 3] = (ramp * 255 * max_opacity).astype(np.uint8)[:, None]
     
-    r = np.full((h, w), color[0])
-    g = np.full((h, w), color[1])
-    b = np.full((h, w), color[2])
-    
-    img_array = np.dstack((r, g, b, alpha)).astype(np.uint8)
-    
-    return ImageClip(img_array)
+    img_array.setflags(write=False)
+    return img_array
+
+@functools.lru_cache(maxsize=32)
+def load_font(font, fontsize):
+    """Opens a font file once per size (TextClip reopens it three times for every text)."""
+    return ImageFont.truetype(font, fontsize)
+
+def render_text(text, font, fontsize, color, align='left', stroke_color=None, stroke_width=0, spacing=4):
+    """
+    Rasterises text into an RGBA array with Pillow, laid out exactly like
+    TextClip(method='label'), but with a cached font and a single measuring pass.
+    """
+    pil_font = load_font(font, fontsize)
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    left, top, right, bottom = draw.multiline_textbbox(
+        (0, 0), text, font=pil_font, spacing=spacing, align=align,
+        stroke_width=stroke_width, anchor="ls"
+    )
+
+    # Height as TextClip computes it: the line spacing Pillow uses, plus the font's own height
+    ascent, descent = pil_font.getmetrics()
+    try:
+        line_height = draw._multiline_spacing(pil_font, spacing, stroke_width)
+        height = int(text.count("\n") * line_height + ascent + descent + stroke_width * 2)
+    except AttributeError:
+        # Private helper missing from newer Pillow versions
+        height = int(bottom - top)
+
+    img = Image.new("RGBA", (int(right - left), height), (0, 0, 0, 0))
+    ImageDraw.Draw(img).multiline_text(
+        (stroke_width, ascent + stroke_width), text, fill=color, font=pil_font,
+        spacing=spacing, align=align, stroke_width=stroke_width, stroke_fill=stroke_color, anchor="ls"
+    )
+    return np.array(img)
+
+def wrap_text(text, font, fontsize, max_width, stroke_width=0):
+    """
+    Wraps text at word boundaries so every line fits max_width pixels, measured with
+    the font itself. Existing line breaks are kept; a word wider than a line gets its own.
+    """
+    pil_font = load_font(font, fontsize)
+    max_width -= 2 * stroke_width
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and pil_font.getlength(candidate) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return "\n".join(lines)
 
 def create_text_clip(text, font, fontsize, color, size, align='left', stroke_color=None, stroke_width=0):
     """
-    Creates a TextClip with robust error handling for missing fonts and wrapping.
+    Creates a text ImageClip with robust error handling for missing fonts and wrapping.
     Fonts have to be in the same folder and named explicitly. Function does not access system fonts.
     """
     if not text:
         return None
 
     safe_width_px = int(size[0]) if size[0] else 1000
-    avg_char_width = fontsize * 0.5 
-    max_chars_per_line = max(1, int(safe_width_px / avg_char_width))
-    
-    if len(text) > max_chars_per_line:
-        final_text = textwrap.fill(text, width=max_chars_per_line)
-    else:
-        final_text = text
-    
-    final_text = final_text + "\n"
 
     try:
-        clip = TextClip(
-            text=final_text, 
-            font_size=fontsize, 
-            color=color, 
-            font=font,
-            method='label', 
-            text_align=align, 
-            stroke_color=stroke_color,
-            stroke_width=stroke_width
-        )
+        final_text = wrap_text(text, font, fontsize, safe_width_px, stroke_width) + "\n"
+        clip = ImageClip(render_text(
+            final_text, font, fontsize, color, align=align,
+            stroke_color=stroke_color, stroke_width=stroke_width
+        ))
         
         if clip.w == 0 or clip.h == 0:
-            print(f"[WARNING] Generated TextClip has 0 dimensions.")
+            print(f"[WARNING] Generated text clip has 0 dimensions.")
             return None
             
         return clip
@@ -120,7 +214,7 @@ def create_text_clip(text, font, fontsize, color, size, align='left', stroke_col
 
 def create_sidebar_clip(width, height, direction, title, caption, title_font='Arial', title_size=30, caption_font='Arial', caption_size=20):
     """
-    Creates a composite clip containing the gradient background and text.
+    Creates a still clip (with mask) containing the gradient background and text.
     Adapts layout dynamically to left, right, top, or bottom positioning.
     """
     # 1. Establish Layout based on orientation
@@ -185,28 +279,243 @@ def create_sidebar_clip(width, height, direction, title, caption, title_font='Ar
         c_clip = c_clip.with_position((x_pos, current_y))
         layers.append(c_clip)
 
-    return CompositeVideoClip(layers, size=(bg_width, bg_height))
+    # Every layer is a still image, so compose them once here and return a single
+    # ImageClip, rather than have the story render blend text over gradient every frame
+    sidebar = CompositeVideoClip(layers, size=(bg_width, bg_height))
+    return ImageClip(sidebar.get_frame(0)).with_mask(ImageClip(sidebar.mask.get_frame(0), is_mask=True))
+
+def cross_fade_in(clip, duration):
+    """
+    Same result as vfx.CrossFadeIn, in one pass over the mask per frame: the opacity is
+    written straight into the mask instead of fading the mask and then blending it with 0.
+    """
+    if clip.mask is None:
+        w, h = clip.size
+        def mask_frame(t):
+            return np.full((h, w), min(t / duration, 1.0))
+    else:
+        mask = clip.mask
+        def mask_frame(t):
+            frame = mask.get_frame(t)
+            return frame if t >= duration else (t / duration) * frame
+    return clip.with_mask(VideoClip(mask_frame, is_mask=True, duration=clip.duration))
+
+def write_video_threaded(clip, output_path, fps, threads=0, preset=X264_PRESET, crf=X264_CRF, hw_accel=HW_ACCEL,
+                         frame_range=None):
+    """
+    Writes clip like write_videofile(codec='libx264', audio_codec='aac') (or with the hardware
+    encoder picked by detect_encoder), but frames are
+    handed to a writer thread through a bounded queue. Compositing frame N then overlaps
+    with piping frame N-1 into ffmpeg, instead of the two alternating on one thread.
+    frame_range (first, end) only writes those frame indices, at the same times iter_frames uses.
+    """
+    audiofile = None
+    if clip.audio is not None:
+        # Encode the soundtrack first, as write_videofile does, and mux it without re-encoding
+        name = os.path.splitext(os.path.basename(output_path))[0]
+        audiofile = f"{name}TEMP_MPY_wvf_snd.m4a"
+        clip.audio.write_audiofile(audiofile, fps=44100, codec='aac', logger=None)
+
+    frames = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    errors = []
+
+    def write_frames(writer):
+        try:
+            while (frame := frames.get()) is not None:
+                writer.write_frame(frame)
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so the compositing thread never blocks on a full queue
+            while frames.get() is not None:
+                pass
+
+    codec, preset, params = encoder_options(preset, crf, hw_accel)
+    try:
+        with FFMPEG_VideoWriter(
+            output_path, clip.size, fps, codec=codec, preset=preset or 'medium', ffmpeg_params=params,
+            audiofile=audiofile, audio_codec='copy' if audiofile else None,
+            threads=threads, with_mask=clip.mask is not None
+        ) as writer:
+            writer_thread = threading.Thread(target=write_frames, args=(writer,))
+            writer_thread.start()
+            try:
+                first, end = frame_range or (0, int(clip.duration * fps))
+                for frame_index in range(first, end):
+                    if errors:
+                        break
+                    t = frame_index / fps
+                    frame = clip.get_frame(t)
+                    if frame.dtype != np.uint8:
+                        frame = frame.astype('uint8')
+                    if clip.mask is not None:
+                        mask = (255 * clip.mask.get_frame(t)).astype('uint8')
+                        frame = np.dstack([frame, mask])
+                    frames.put(frame)
+            finally:
+                frames.put(None)
+                writer_thread.join()
+        if errors:
+            raise errors[0]
+    finally:
+        if audiofile and os.path.exists(audiofile):
+            os.remove(audiofile)
+
+@functools.lru_cache(maxsize=None)
+def detect_encoder(hw_accel=HW_ACCEL):
+    """
+    Returns (codec, preset, extra ffmpeg params) for the H.264 encoder to use.
+    preset is None for libx264, see encoder_options. hw_accel 'none' always picks libx264.
+    """
+    if hw_accel in HW_BACKENDS:
+        candidates = [(codec, preset) for codec, preset in HW_ENCODERS if codec == HW_BACKENDS[hw_accel]]
+    else:
+        candidates = HW_ENCODERS if hw_accel == 'auto' else []
+    if candidates:
+        try:
+            listed = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-encoders'],
+                                    capture_output=True, text=True).stdout
+        except OSError:
+            listed = ""
+        for codec, preset in candidates:
+            if f" {codec} " not in listed:
+                continue
+            # ffmpeg lists the encoders it was built with, not the ones this machine has
+            # a device for, so check with a short test encode
+            test = [FFMPEG_BINARY, '-v', 'error', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+                    '-c:v', codec, '-f', 'null', '-']
+            if subprocess.run(test, capture_output=True).returncode == 0:
+                print(f"Using hardware encoder {codec}")
+                return codec, preset, ['-b:v', HW_BITRATE]
+    return 'libx264', None, []
+
+def encoder_options(preset=X264_PRESET, crf=X264_CRF, hw_accel=HW_ACCEL):
+    """Returns detect_encoder's choice, with the given preset and crf when it is libx264."""
+    codec, hw_preset, params = detect_encoder(hw_accel)
+    if codec == 'libx264':
+        return codec, preset, ['-crf', str(crf)]
+    return codec, hw_preset, params
+
+@functools.lru_cache(maxsize=256)
+def _probe_media(path, mtime):
+    try:
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'quiet', '-print_format', 'json',
+            '-show_format', '-show_streams', '-select_streams', 'v:0', path
+        ])
+    except FileNotFoundError:
+        # No ffprobe on this machine: let MoviePy's ffmpeg read the header instead
+        infos = ffmpeg_parse_infos(path)
+        width, height = infos.get('video_size') or (None, None)
+        return width, height, infos['duration']
+
+    info = json.loads(output)
+    streams = info.get('streams') or [{}]
+    return streams[0].get('width'), streams[0].get('height'), float(info['format']['duration'])
+
+def probe_media(path):
+    """
+    Returns (width, height, duration) of a media file from its header, without decoding.
+    Width and height are None for audio-only files. Results are cached per file
+    version (path and mtime), so each file is probed once across the pipeline.
+    """
+    return _probe_media(path, os.path.getmtime(path))
+
+def probe_audio_codec(path):
+    """Returns the codec name of a media file's first audio stream, or None if it has none."""
+    try:
+        output = subprocess.run([
+            'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', path
+        ], capture_output=True, text=True).stdout.strip()
+        return output or None
+    except FileNotFoundError:
+        # No ffprobe on this machine: read the stream list ffmpeg prints for its input
+        stderr = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-i', path],
+                                capture_output=True, text=True).stderr
+        match = re.search(r'Audio: (\w+)', stderr)
+        return match.group(1) if match else None
+
+def load_overlay_image(image_path, scale=1.0):
+    """
+    Reads an overlay image as an RGB or RGBA (if it has transparency) uint8 array, already
+    resized by scale with the same Lanczos filter as clip.resized, so it's resampled only once.
+    """
+    image = Image.open(image_path)
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    if scale != 1.0:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.Resampling.LANCZOS)
+    return np.asarray(image)
+
+# MoviePy's single-word positions, as (x, y) pairs
+NAMED_POSITIONS = {'center': ('center', 'center'), 'left': ('left', 'center'), 'right': ('right', 'center'),
+                   'top': ('center', 'top'), 'bottom': ('center', 'bottom')}
+
+def fixed_position(position):
+    """
+    Returns a MoviePy position as an (x, y) pair of names or pixels, or None when it has
+    no fixed value the ffmpeg graph can use (a function of time, for instance).
+    """
+    if isinstance(position, str):
+        return NAMED_POSITIONS.get(position)
+    if callable(position) or len(position) != 2:
+        return None
+    x, y = position
+    if ((x in ('left', 'center', 'right') or isinstance(x, (int, float)))
+            and (y in ('top', 'center', 'bottom') or isinstance(y, (int, float)))):
+        return x, y
+    return None
+
+def pixel_position(position, container, size):
+    """Resolves one coordinate of a MoviePy position ('left', 'center', 10, ...) to pixels."""
+    named = {'left': 0, 'top': 0, 'center': (container - size) / 2, 'right': container - size, 'bottom': container - size}
+    return int(named.get(position, position))
+
+def ffmpeg_position(position, axis):
+    """Translates one coordinate of a MoviePy position into an ffmpeg overlay expression."""
+    if axis == 'x':
+        named = {'left': '0', 'center': 'trunc((W-w)/2)', 'right': 'W-w'}
+    else:
+        named = {'top': '0', 'center': 'trunc((H-h)/2)', 'bottom': 'H-h'}
+    return named.get(position, str(position))
 
 class VideoCompositor:
-    def __init__(self, base_video_path):
+    def __init__(self, base_video_path, drop_audio=False):
         if not os.path.exists(base_video_path):
             raise FileNotFoundError(f"Video file not found: {base_video_path}")
             
-        self.base_clip = VideoFileClip(base_video_path)
-        self.elements = [self.base_clip]
-        self.duration = self.base_clip.duration
-        self.video_width = self.base_clip.w
-        self.video_height = self.base_clip.h
+        self.base_video_path = base_video_path
+        # For bases whose soundtrack is replaced later: it is then neither decoded nor re-encoded
+        self.drop_audio = drop_audio
+        # Only the header is read here; the clip itself is opened if MoviePy has to render
+        self.video_width, self.video_height, self.duration = probe_media(base_video_path)
+        self.base_effects = []
+        self.elements = []
+
+        # Overlays shown for the whole video are flattened into one premultiplied RGBA layer
+        # (colour in 0-255, alpha in 0-1) and blended with NumPy, instead of one clip each
+        self.static_color = None
+        self.static_alpha = None
+
+        # The same edits, described as ffmpeg filter parameters. Set to None as soon as an
+        # overlay's position can't be expressed in the filter graph (see fixed_position),
+        # and render falls back to MoviePy with the clips in self.elements.
+        self.base_fades = None
+        self.ffmpeg_overlays = []
+        # Text rasters written for the ffmpeg graph, removed after rendering
+        self.temp_files = []
 
     def apply_base_transitions(self, fade_in=0, fade_out=0, color=(0,0,0)):
-        effects = []
+        # No fades: leave the base untouched rather than adding empty filters and effects
+        if fade_in <= 0 and fade_out <= 0:
+            return
+        self.base_fades = (fade_in, fade_out, color)
+
         if fade_in > 0:
-            effects.append(vfx.FadeIn(duration=fade_in, initial_color=color))
+            self.base_effects.append(vfx.FadeIn(duration=fade_in, initial_color=color))
         if fade_out > 0:
-            effects.append(vfx.FadeOut(duration=fade_out, final_color=color))
-        
-        if effects:
-            self.elements[0] = self.elements[0].with_effects(effects)
+            self.base_effects.append(vfx.FadeOut(duration=fade_out, final_color=color))
 
     def add_image_overlay(self, image_path, start_time=0, duration=None, 
                           position=('center', 'center'), opacity=1.0, scale=1.0,
@@ -215,12 +524,25 @@ class VideoCompositor:
             print(f"Warning: Image path {image_path} not found.")
             return
 
-        new_clip = ImageClip(image_path)
         final_duration = duration if duration else (self.duration - start_time)
-        new_clip = new_clip.with_start(start_time).with_duration(final_duration)
+        fixed = fixed_position(position)
+        if fixed is None:
+            self.ffmpeg_overlays = None
+        if self.ffmpeg_overlays is not None:
+            self.ffmpeg_overlays.append({
+                "path": image_path, "start": start_time, "duration": final_duration,
+                "position": fixed, "opacity": opacity, "scale": scale,
+                "fade_in": fade_in, "fade_out": fade_out
+            })
+
+        # Static overlays below every other element can go in the flattened layer
+        if (fixed is not None and start_time == 0 and final_duration >= self.duration
+                and fade_in == 0 and fade_out == 0 and not self.elements):
+            self.add_static_overlay(image_path, fixed, opacity, scale)
+            return
 
-        if scale != 1.0:
-            new_clip = new_clip.resized(scale)
+        new_clip = ImageClip(load_overlay_image(image_path, scale))
+        new_clip = new_clip.with_start(start_time).with_duration(final_duration)
         new_clip = new_clip.with_opacity(opacity).with_position(position)
 
         effects = []
@@ -230,6 +552,31 @@ class VideoCompositor:
 
         self.elements.append(new_clip)
 
+    def add_static_overlay(self, image_path, position, opacity, scale):
+        """Alpha-composites an image onto the flattened static overlay layer."""
+        W, H = self.video_width, self.video_height
+        if self.static_color is None:
+            self.static_color = np.zeros((H, W, 3), dtype=np.float32)
+            self.static_alpha = np.zeros((H, W, 1), dtype=np.float32)
+
+        pixels = load_overlay_image(image_path, scale).astype(np.float32)
+        if pixels.shape[2] == 3:
+            pixels = np.dstack((pixels, np.full(pixels.shape[:2], 255, dtype=np.float32)))
+        h, w = pixels.shape[:2]
+
+        # Clip the image to the frame
+        x = pixel_position(position[0], W, w)
+        y = pixel_position(position[1], H, h)
+        x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, W), min(y + h, H)
+        if x0 >= x1 or y0 >= y1:
+            return
+        src = pixels[y0 - y:y1 - y, x0 - x:x1 - x]
+        alpha = src[..., 3:4] * (opacity / 255)
+
+        region = (slice(y0, y1), slice(x0, x1))
+        self.static_color[region] = src[..., :3] * alpha + self.static_color[region] * (1 - alpha)
+        self.static_alpha[region] = alpha + self.static_alpha[region] * (1 - alpha)
+
     def add_text_overlay(self, text, font='Arial', fontsize=50, color='white', 
                          start_time=0, duration=None, position=('center', 'bottom'), 
                          opacity=1.0, stroke_color=None, stroke_width=0,
@@ -242,6 +589,17 @@ class VideoCompositor:
         
         if txt_clip:
             final_duration = duration if duration else (self.duration - start_time)
+            fixed = fixed_position(position)
+            if fixed is None:
+                self.ffmpeg_overlays = None
+            if self.ffmpeg_overlays is not None:
+                # The text is static, so rasterise it once and let ffmpeg overlay it like an image
+                self.ffmpeg_overlays.append({
+                    "path": self.save_text_raster(txt_clip), "start": start_time,
+                    "duration": final_duration, "position": fixed, "opacity": opacity,
+                    "scale": 1.0, "fade_in": fade_in, "fade_out": fade_out
+                })
+
             txt_clip = txt_clip.with_start(start_time).with_duration(final_duration)
             txt_clip = txt_clip.with_opacity(opacity).with_position(position)
 
@@ -252,23 +610,158 @@ class VideoCompositor:
 
             self.elements.append(txt_clip)
 
-    def render(self, output_path, fps=24):
-        final_video = CompositeVideoClip(self.elements, size=self.base_clip.size)
-        final_video.write_videofile(output_path, fps=fps, codec='libx264', audio_codec='aac', threads=4)
+    def save_text_raster(self, txt_clip):
+        """Writes the text clip (colour plus mask) to a temporary RGBA png and returns its path."""
+        rgb = txt_clip.get_frame(0)
+        alpha = txt_clip.mask.get_frame(0) * 255 if txt_clip.mask is not None else np.full(rgb.shape[:2], 255)
+        rgba = np.dstack((rgb, alpha)).astype(np.uint8)
+
+        fd, path = tempfile.mkstemp(suffix=".png")
+        with os.fdopen(fd, 'wb') as f:
+            Image.fromarray(rgba, 'RGBA').save(f, format='PNG')
+        self.temp_files.append(path)
+        return path
+
+    def build_ffmpeg_command(self, output_path, fps, preset=X264_PRESET, crf=X264_CRF, hw_accel=HW_ACCEL):
+        """
+        Builds a single ffmpeg command that renders the base video with its fades and
+        every image overlay as one filter_complex graph, so all pixel work stays in libav.
+        """
+        codec, preset, params = encoder_options(preset, crf, hw_accel)
+        # A machine with a working hardware encoder also decodes the base on that device
+        hw_decode = ["-hwaccel", HW_DECODERS[codec]] if codec in HW_DECODERS else []
+        command = [FFMPEG_BINARY, "-y", "-v", "error", *hw_decode, "-i", self.base_video_path]
+        filters = []
+
+        # Resample the base on the output grid like MoviePy, which shows at t = i / fps the
+        # last source frame at or before t, and stops after int(duration * fps) frames
+        video_duration = ffmpeg_parse_infos(self.base_video_path).get('video_duration') or self.duration
+        base_filters = [f"fps={fps}:round=up"]
+        if self.base_fades:
+            fade_in, fade_out, color = self.base_fades
+            hex_color = "0x{:02x}{:02x}{:02x}".format(*color)
+            if fade_in > 0:
+                base_filters.append(f"fade=t=in:st=0:d={fade_in}:color={hex_color}")
+            if fade_out > 0:
+                base_filters.append(f"fade=t=out:st={video_duration - fade_out}:d={fade_out}:color={hex_color}")
+        filters.append(f"[0:v]{','.join(base_filters)}[v0]")
+
+        for i, overlay in enumerate(self.ffmpeg_overlays, 1):
+            start, duration = overlay["start"], overlay["duration"]
+            # Images loop at the output rate, so their fades are sampled on the same frames
+            command += ["-loop", "1", "-framerate", str(fps), "-t", str(duration), "-i", overlay["path"]]
+
+            chain = ["format=rgba"]
+            if overlay["scale"] != 1.0:
+                chain.append(f"scale=iw*{overlay['scale']}:ih*{overlay['scale']}")
+            if overlay["opacity"] != 1.0:
+                chain.append(f"colorchannelmixer=aa={overlay['opacity']}")
+            if overlay["fade_in"] > 0:
+                chain.append(f"fade=t=in:st=0:d={overlay['fade_in']}:alpha=1")
+            if overlay["fade_out"] > 0:
+                chain.append(f"fade=t=out:st={duration - overlay['fade_out']}:d={overlay['fade_out']}:alpha=1")
+            # Shift the overlay to its start time on the base timeline
+            chain.append(f"setpts=PTS-STARTPTS+{start}/TB")
+            filters.append(f"[{i}:v]{','.join(chain)}[ov{i}]")
+
+            x = ffmpeg_position(overlay["position"][0], 'x')
+            y = ffmpeg_position(overlay["position"][1], 'y')
+            # Blend in RGB like MoviePy does, so alpha edges are not chroma-subsampled
+            filters.append(f"[v{i-1}][ov{i}]overlay=x={x}:y={y}:eof_action=pass:format=rgb[v{i}]")
+
+        command += [
+            "-filter_complex", ";".join(filters),
+            "-map", f"[v{len(self.ffmpeg_overlays)}]",
+            *(["-an"] if self.drop_audio else ["-map", "0:a?", "-c:a", self.audio_codec_option()]),
+            "-frames:v", str(int(video_duration * fps)), "-r", str(fps), "-c:v", codec, *(["-preset", preset] if preset else []), *params,
+            "-threads", "0", "-pix_fmt", "yuv420p", output_path
+        ]
+        return command
+
+    def audio_codec_option(self):
+        """The base audio is copied as is when it is already AAC, and only re-encoded otherwise."""
+        return 'copy' if probe_audio_codec(self.base_video_path) == 'aac' else 'aac'
+
+    def render(self, output_path, fps=24, preset=X264_PRESET, crf=X264_CRF, hw_accel=HW_ACCEL):
+        try:
+            if self.ffmpeg_overlays is not None:
+                subprocess.run(self.build_ffmpeg_command(output_path, fps, preset, crf, hw_accel), check=True)
+                return
+        finally:
+            for path in self.temp_files:
+                os.remove(path)
+            self.temp_files = []
+
+        base_clip = VideoFileClip(self.base_video_path, audio=not self.drop_audio)
+        if self.base_effects:
+            base_clip = base_clip.with_effects(self.base_effects)
+
+        if self.static_alpha is not None:
+            # out = frame * (1 - alpha) + color, in 8.8 fixed point on uint16
+            inverse = np.rint((1 - self.static_alpha) * 256).astype(np.uint16)
+            color = np.rint(self.static_color * 256).astype(np.uint16)
+
+            def blend_static(frame):
+                out = frame.astype(np.uint16)
+                out *= inverse
+                out += color
+                out >>= 8
+                return out.astype(np.uint8)
+
+            base_clip = base_clip.image_transform(blend_static)
+        final_video = CompositeVideoClip([base_clip] + self.elements, size=base_clip.size)
+        write_video_threaded(final_video, output_path, fps=fps, preset=preset, crf=crf, hw_accel=hw_accel)
+
+class TimelineClip(CompositeVideoClip):
+    """
+    CompositeVideoClip for long timelines. The clips playing at time t are found with one
+    vectorized test over arrays of start and end times, instead of calling is_playing on
+    every clip for every frame (about 7 us per clip).
+    Video files only keep their ffmpeg reader open while they are on screen, so a render
+    holds a couple of decoders at a time instead of one per scene.
+    """
+    def __init__(self, clips, *args, **kwargs):
+        super().__init__(clips, *args, **kwargs)
+        # self.clips is now sorted by layer, the arrays follow the same order
+        self.starts = np.array([clip.start for clip in self.clips], dtype=float)
+        self.ends = np.array([np.inf if clip.end is None else clip.end for clip in self.clips], dtype=float)
+        self.readers = [getattr(clip, 'reader', None) for clip in self.clips]
+        self.reader_open = np.zeros(len(self.clips), dtype=bool)
+
+    def playing_clips(self, t=0):
+        playing = np.flatnonzero((self.starts <= t) & (t < self.ends))
+
+        for i in np.flatnonzero(self.reader_open & (self.ends <= t)):
+            self.readers[i].close()
+            self.reader_open[i] = False
+        for i in playing:
+            reader = self.readers[i]
+            if reader is not None and not self.reader_open[i]:
+                if reader.proc is None:
+                    # Open the decoder through the clip so Loop or speed effects map the local
+                    # time to the source time, MoviePy prints a notice when it reopens a reader
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        self.clips[i].get_frame(t - self.starts[i])
+                self.reader_open[i] = True
+
+        return [self.clips[i] for i in playing]
 
 # --- New Story Sequencer ---
 class StorySequencer:
-    def __init__(self, output_width=1024, output_height=576):
+    def __init__(self, output_width=1024, output_height=576, resize_quality='best'):
         self.w = output_width
         self.h = output_height
+        self.resize_quality = resize_quality  # 'fast' for previews
         self.clips = [] 
         self.current_time = 0.0
+        self.scenes = []  # add_scene arguments of every scene added, to rebuild the story elsewhere
 
     def add_scene(self, video_path, title, caption, title_font ='Arial',
                     caption_font = 'Arial',
                     effects_duration = 0.5,      # Fade animation length
                     text_direction='left',       # 'left', 'right', 'top', 'bottom'
-                    audio_path=None              # Optional audio path
+                    audio_path=None,             # Optional audio path
+                    prepared=None                # Result of prepare_scene, if already done
                     ):
         """
         Creates a composite scene with sliding intro, side-bar text, and optional audio.
@@ -278,17 +771,19 @@ class StorySequencer:
         slide_duration = effects_duration
         fade_duration = effects_duration
 
-        if not os.path.exists(video_path):
+        if prepared is None:
+            prepared = self.prepare_scene(video_path, title, caption, title_font, caption_font,
+                                          text_direction, audio_path)
+        if prepared is None:
             print(f"Skipping scene: Missing {video_path}")
             return
+        video_clip, first_frame, audio_clip, sidebar_clip = prepared
+        self.scenes.append(dict(
+            video_path=video_path, title=title, caption=caption, title_font=title_font,
+            caption_font=caption_font, effects_duration=effects_duration,
+            text_direction=text_direction, audio_path=audio_path
+        ))
 
-        # Load Video
-        # Resizing for good measure
-        raw_clip = VideoFileClip(video_path)
-        video_clip = resize_and_crop(raw_clip, self.w, self.h)
-        
-        # Extract first frame
-        first_frame = video_clip.get_frame(0)
         intro_bg = ImageClip(first_frame)
 
         # Calculate Overlap and Start Time
@@ -301,14 +796,11 @@ class StorySequencer:
         # Intro 
         intro_bg = intro_bg.with_start(scene_start_time).with_duration(intro_duration)
         
-        effects = []
         if fade_duration > 0:
-            effects.append(vfx.CrossFadeIn(duration=fade_duration))
+            intro_bg = cross_fade_in(intro_bg, fade_duration)
         if slide_duration > 0:
-            effects.append(vfx.SlideIn(duration=slide_duration, side=text_direction))
-        
-        if effects:
-            intro_bg = intro_bg.with_effects(effects)
+            # SlideIn only animates the position, it does no per-pixel work
+            intro_bg = intro_bg.with_effects([vfx.SlideIn(duration=slide_duration, side=text_direction)])
         
         self.clips.append(intro_bg)
 
@@ -316,19 +808,15 @@ class StorySequencer:
         video_start_time = scene_start_time + intro_duration
         
         # Handle Audio and Looping
-        if audio_path and os.path.exists(audio_path):
-            audio_clip = AudioFileClip(audio_path)
-            
+        if audio_clip is not None:
             # If Audio is longer than Video, Loop the Video
             if audio_clip.duration > video_clip.duration:
                 # Calculate required loops
                 loops = math.ceil(audio_clip.duration / video_clip.duration)
                 print(f"  [Looping] Audio ({audio_clip.duration:.2f}s) > Video ({video_clip.duration:.2f}s). Looping {loops} times.")
                 
-                # Loop by concatenating
-                video_clip = concatenate_videoclips([video_clip] * loops)
-                # Trim to exact audio length
-                video_clip = video_clip.with_duration(audio_clip.duration)
+                # Loop by wrapping the time axis, up to the exact audio length
+                video_clip = video_clip.with_effects([vfx.Loop(duration=audio_clip.duration)])
             
             # Attach audio to video
             video_clip = video_clip.with_audio(audio_clip)
@@ -338,25 +826,7 @@ class StorySequencer:
         self.clips.append(video_clip)
 
         # Side-Bar Text Overlay
-        if title or caption:
-            # Orientation affects text boundaries
-            if text_direction in ['top', 'bottom']:
-                sidebar_width_target = self.w
-                sidebar_height_target = int(self.h * 0.3)
-            else:
-                sidebar_width_target = int(self.w * 0.3)
-                sidebar_height_target = self.h
-            
-            sidebar_clip = create_sidebar_clip(
-                width=sidebar_width_target,
-                height=sidebar_height_target,
-                direction=text_direction,
-                title=title,
-                caption=caption,
-                title_font = title_font,
-                caption_font = caption_font
-            )
-            
+        if sidebar_clip is not None:
             # Text starts when video starts and lasts for the full duration of the video
             text_dur = video_clip.duration
             sidebar_clip = sidebar_clip.with_start(video_start_time).with_duration(text_dur)
@@ -389,30 +859,134 @@ class StorySequencer:
 
             sidebar_clip = sidebar_clip.with_position(slide_pos)
             
-            text_effects = [vfx.CrossFadeIn(duration=0.5)]
-            sidebar_clip = sidebar_clip.with_effects(text_effects)
+            sidebar_clip = cross_fade_in(sidebar_clip, 0.5)
             
             self.clips.append(sidebar_clip)
 
         # Update Cursor
         self.current_time = video_start_time + video_clip.duration
 
-    def render(self, output_path, fps=24):
+    def prepare_scene(self, video_path, title, caption, title_font='Arial', caption_font='Arial',
+                      text_direction='left', audio_path=None):
+        """
+        Opens the video (resized to the output) and audio of a scene, decodes its first frame
+        and builds its sidebar. Doesn't touch the timeline, so scenes can be prepared in parallel.
+        Returns (video_clip, first_frame, audio_clip, sidebar_clip), or None if the video is missing.
+        """
+        if not os.path.exists(video_path):
+            return None
+
+        # Resizing for good measure
+        video_clip = open_video_filled(video_path, self.w, self.h, self.resize_quality)
+        first_frame = video_clip.get_frame(0)
+        # Release the decoder until the scene plays, TimelineClip reopens it then
+        video_clip.reader.close()
+        audio_clip = AudioFileClip(audio_path) if audio_path and os.path.exists(audio_path) else None
+
+        sidebar_clip = None
+        if title or caption:
+            # Orientation affects text boundaries
+            if text_direction in ['top', 'bottom']:
+                sidebar_width_target = self.w
+                sidebar_height_target = int(self.h * 0.3)
+            else:
+                sidebar_width_target = int(self.w * 0.3)
+                sidebar_height_target = self.h
+            
+            sidebar_clip = create_sidebar_clip(
+                width=sidebar_width_target,
+                height=sidebar_height_target,
+                direction=text_direction,
+                title=title,
+                caption=caption,
+                title_font = title_font,
+                caption_font = caption_font
+            )
+        return video_clip, first_frame, audio_clip, sidebar_clip
+
+    def add_scenes(self, scenes):
+        """
+        Adds several scenes, given as dicts of add_scene arguments, in order.
+        Their files are opened and their sidebars built in parallel first; the timeline
+        itself is then built one scene after the other.
+        """
+        def prepare(scene):
+            return self.prepare_scene(
+                scene["video_path"], scene.get("title"), scene.get("caption"),
+                title_font=scene.get("title_font", 'Arial'), caption_font=scene.get("caption_font", 'Arial'),
+                text_direction=scene.get("text_direction", 'left'), audio_path=scene.get("audio_path")
+            )
+
+        with ThreadPoolExecutor(max_workers=SCENE_PREP_WORKERS) as executor:
+            prepared = list(executor.map(prepare, scenes))
+
+        for scene, scene_prepared in zip(scenes, prepared):
+            self.add_scene(**scene, prepared=scene_prepared)
+
+    def timeline(self):
+        """Returns the whole story as one clip."""
+        bg = ColorClip(size=(self.w, self.h), color=(0,0,0), duration=self.current_time)
+        # The opaque background is the composite's base (use_bgclip), so MoviePy doesn't also
+        # composite a transparency mask every frame that the H.264 encoder would discard
+        return TimelineClip([bg] + self.clips, use_bgclip=True)
+
+    def render(self, output_path, fps=24, preset=X264_PRESET, crf=X264_CRF, hw_accel=HW_ACCEL,
+               workers=RENDER_WORKERS):
         if not self.clips:
             print("No clips to render.")
             return
 
         print(f"Compositing {len(self.clips)} elements...")
         total_duration = self.current_time
-        bg = ColorClip(size=(self.w, self.h), color=(0,0,0), duration=total_duration)
-        final_movie = CompositeVideoClip([bg] + self.clips)
+        final_movie = self.timeline()
         
         print(f"Rendering full story to {output_path} (Duration: {total_duration:.2f}s)...")
-        final_movie.write_videofile(
-            output_path, 
-            fps=fps, 
-            codec='libx264', 
-            audio_codec='aac',
-            threads=4
-        )
-        print("Story render complete!")
\ No newline at end of file
+        segments = min(workers, int(total_duration // MIN_SEGMENT_SECONDS))
+        if segments > 1:
+            self.render_segments(final_movie, output_path, fps, segments, preset, crf, hw_accel)
+        else:
+            write_video_threaded(final_movie, output_path, fps=fps, preset=preset, crf=crf, hw_accel=hw_accel)
+        print("Story render complete!")
+
+    def render_segments(self, final_movie, output_path, fps, segments, preset, crf, hw_accel):
+        """
+        Renders the story as consecutive stretches of frames in parallel processes, then joins
+        them and the soundtrack without re-encoding. Compositing runs in Python on one core
+        per process, so this spreads it over the machine. The frames are the same as a
+        single pass; each stretch starts on a keyframe.
+        """
+        n_frames = int(final_movie.duration * fps)
+        bounds = [round(i * n_frames / segments) for i in range(segments + 1)]
+        print(f"  Rendering in {segments} processes...")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parts = [os.path.join(tmp, f"part_{i}.mp4") for i in range(segments)]
+            # Spawned, so the workers don't inherit this process's open ffmpeg readers
+            with ProcessPoolExecutor(max_workers=segments, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [
+                    executor.submit(render_story_segment, (self.w, self.h), self.resize_quality, self.scenes,
+                                    (bounds[i], bounds[i + 1]), part, fps, preset, crf, hw_accel)
+                    for i, part in enumerate(parts)
+                ]
+                for future in futures:
+                    future.result()
+
+            list_path = os.path.join(tmp, "parts.txt")
+            with open(list_path, 'w') as f:
+                f.writelines(f"file '{part}'\n" for part in parts)
+
+            command = [FFMPEG_BINARY, '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+            if final_movie.audio is not None:
+                audiofile = os.path.join(tmp, "audio.m4a")
+                final_movie.audio.write_audiofile(audiofile, fps=44100, codec='aac', logger=None)
+                command += ['-i', audiofile, '-map', '0:v', '-map', '1:a']
+            subprocess.run(command + ['-c', 'copy', output_path], check=True)
+
+def render_story_segment(size, resize_quality, scenes, frame_range, output_path, fps, preset, crf, hw_accel):
+    """Worker of StorySequencer.render_segments: rebuilds the story and writes frame_range of it, silent."""
+    sequencer = StorySequencer(*size, resize_quality=resize_quality)
+    # The parent already logged every scene
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sequencer.add_scenes(scenes)
+    write_video_threaded(sequencer.timeline().without_audio(), output_path, fps=fps, preset=preset,
+                         crf=crf, hw_accel=hw_accel, frame_range=frame_range)
\ No newline at end of file
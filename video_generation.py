@@ -1,7 +1,15 @@
 import os
+import atexit
+import json
+import shutil
+import tempfile
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import fal_client
 import requests
-import mimetypes
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging as log 
 
@@ -10,15 +18,68 @@ DEFAULT_VISION_ENDPOINT = "openrouter/router/vision"
 DEFAULT_VISION_MODEL = "google/gemini-2.5-flash" 
 DEFAULT_VIDEO_ENDPOINT = "fal-ai/vidu/q3/image-to-video"
 
+# Videos generated at the same time by mass_generation, kept low for Fal.ai rate limits
+GENERATION_WORKERS = 8
+# Fal.ai upload URLs and vision prompts of images already processed, by image content hash
+FAL_CACHE_FILE = os.path.join(".cache", "fal_cache.json")
+# Fal.ai storage URLs expire, so uploads older than this are redone instead of reused
+FAL_UPLOAD_TTL = 24 * 60 * 60 # seconds
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB
+DOWNLOAD_TIMEOUT = (10, 60) # seconds to connect, and between bytes received
+
 
 DEFAULT_VOICE_ID = "b8jhBTcGAq4kQGWmKprT" 
 ELEVENLABS_TTS_URL = "https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
 
 load_dotenv()
 
-def generate_video_single(image_path, duration, output_path, prompt=None, model_endpoint=DEFAULT_VIDEO_ENDPOINT, test_mode = False):
+# One session shared by the generation threads, so connections to the Fal.ai CDN are reused
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=GENERATION_WORKERS, pool_maxsize=GENERATION_WORKERS))
+atexit.register(http.close)
+
+_fal_cache = None
+_fal_cache_lock = threading.Lock()
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def cached_fal_entry(digest):
+    """
+    Returns a copy of the cache entry, {url, prompts: {hint: prompt}}, of an image hash,
+    reading FAL_CACHE_FILE on first use. url is None once the upload is older than FAL_UPLOAD_TTL.
+    """
+    global _fal_cache
+    with _fal_cache_lock:
+        if _fal_cache is None:
+            try:
+                with open(FAL_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    _fal_cache = json.load(f)
+            except (OSError, ValueError):
+                _fal_cache = {}
+        entry = _fal_cache.get(digest, {})
+        fresh = time.time() - entry.get("uploaded_at", 0) < FAL_UPLOAD_TTL
+        return {"url": entry.get("url") if fresh else None, "prompts": dict(entry.get("prompts", {}))}
+
+def store_fal_entry(digest, url, hint=None, prompt=None):
+    """Records an image's upload URL (and the prompt generated for a hint) in FAL_CACHE_FILE."""
+    with _fal_cache_lock:
+        entry = _fal_cache.setdefault(digest, {"url": None, "prompts": {}})
+        if entry["url"] != url:
+            entry["url"] = url
+            entry["uploaded_at"] = time.time()
+        if prompt:
+            entry["prompts"][hint or ""] = prompt
+        os.makedirs(os.path.dirname(FAL_CACHE_FILE), exist_ok=True)
+        with open(FAL_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(_fal_cache, f, indent=2)
+
+def generate_video_single(image_path, duration, output_path, prompt=None, model_endpoint=DEFAULT_VIDEO_ENDPOINT, test_mode = False, redo = False):
     """
     Generates a single video with specific parameters.
+    With redo, the vision prompt is generated again instead of taken from the cache.
     """
     if not os.path.exists(image_path):
         log.error("Image not found")
@@ -26,9 +87,18 @@ def generate_video_single(image_path, duration, output_path, prompt=None, model_
     log.info(f"\nProcessing: {image_path}")
 
     try:
+        # Same image as an earlier run: reuse its upload and, for the same hint, its prompt
+        digest = file_digest(image_path)
+        cached = cached_fal_entry(digest)
+
         # Upload Image
-        log.info("  [1/4] Uploading image to Fal.ai storage...")
-        image_url = fal_client.upload_file(image_path)
+        if cached["url"]:
+            log.info("  [1/4] Image already uploaded, reusing its Fal.ai URL.")
+            image_url = cached["url"]
+        else:
+            log.info("  [1/4] Uploading image to Fal.ai storage...")
+            image_url = fal_client.upload_file(image_path)
+            store_fal_entry(digest, image_url)
         
         # Vision Model 
         log.info("  [2/4] Analyzing image with Vision model...")
@@ -42,7 +112,11 @@ def generate_video_single(image_path, duration, output_path, prompt=None, model_
         )
         
         # add hint
-        if not test_mode:
+        if not test_mode and not redo and (prompt or "") in cached["prompts"]:
+            generated_prompt = cached["prompts"][prompt or ""]
+            log.info(f"  --> Cached Prompt: \"{generated_prompt}\"")
+
+        elif not test_mode:
             if prompt:
                 vision_prompt += f" \nIMPORTANT style/context instruction: {prompt}"
 
@@ -62,6 +136,8 @@ def generate_video_single(image_path, duration, output_path, prompt=None, model_
             if not generated_prompt:
                 log.error("  Error: Vision model returned empty prompt. Using fallback.")
                 generated_prompt = "A cinematic video of this scene, high quality, 4k"
+            else:
+                store_fal_entry(digest, image_url, prompt, generated_prompt)
 
         # Video Generation
         log.info(f"  [3/4] Generating video using {model_endpoint}...")
@@ -103,6 +179,7 @@ def mass_generation(
     image_dict, 
     duration = 5,
     model_endpoint = DEFAULT_VIDEO_ENDPOINT, 
+    download_path = "downloads",
     test_mode = False):
     """
     1. Uploads local images to Fal.
@@ -121,27 +198,50 @@ def mass_generation(
         log.critical("Error: FAL_KEY not found. Check .env")
         return
 
-    total = len(image_dict)
-    
-    for i, (image_path, user_hint) in enumerate(image_dict.items(), 1):
-        generate_video_single(image_path, user_hint, duration, output_path, model_endpoint=model_endpoint, test_mode=False)
-        
+    if not image_dict:
+        return
+
+    os.makedirs(download_path, exist_ok=True)
+
+    # Each video waits on several slow network round-trips, so generate them concurrently
+    with ThreadPoolExecutor(max_workers=min(GENERATION_WORKERS, len(image_dict))) as executor:
+        futures = {}
+        for image_path, user_hint in image_dict.items():
+            name = os.path.splitext(os.path.basename(image_path))[0]
+            output_path = os.path.join(download_path, f"{name}.mp4")
+            future = executor.submit(generate_video_single, image_path, duration, output_path,
+                                     prompt=user_hint, model_endpoint=model_endpoint, test_mode=test_mode)
+            futures[future] = image_path
+
+        for future in as_completed(futures):
+            if future.exception():
+                log.error(f"  Error processing {futures[future]}: {future.exception()}")
+
     return 
 
 
 def download_video(url, output_path):
-    """Downloads video directly to a specific file path."""
+    """
+    Downloads video directly to a specific file path. The file is written to a temp file
+    and renamed into place, so a failed download never leaves a truncated video that
+    later runs would take as already generated.
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(output_path) or ".")
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"  Saved to: {output_path}")
+        with os.fdopen(fd, 'wb') as f:
+            response = http.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+
+            # Copy in large blocks in C instead of a Python loop over 8 KB chunks
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+        os.replace(temp_path, output_path)
+        log.info(f"  Saved to: {output_path}")
     except Exception as e:
-        print(f"  Failed to download: {e}")
-
+        log.error(f"  Failed to download: {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
 if __name__ == "__main__":
@@ -1,68 +1,243 @@
+import io
 import os
+import re
+import json
+import shutil
+import atexit
+import hashlib
+import tempfile
+import subprocess
 import requests
-import mimetypes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-import logging as log
+import numpy as np
 from pydub import AudioSegment
 
+# Numba is optional: without it the noise gate uses the plain NumPy path
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# soundfile is optional: libsndfile >= 1.1 decodes MP3 straight into a NumPy array
+try:
+    import soundfile as sf
+    # libsndfile lists MP3 support under the 'MP3' key ('MPEG-1/2 Audio')
+    if 'MP3' not in sf.available_formats():
+        sf = None
+except (ImportError, OSError):
+    sf = None
+
 # Constants
 DEFAULT_VOICE_ID = "b8jhBTcGAq4kQGWmKprT" 
 ELEVENLABS_TTS_URL = "https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+TTS_CONNECTIONS = 8 # Connections kept open to ElevenLabs, one per concurrent scene
+TTS_TIMEOUT = 60 # Seconds to wait for a connection or for the next block of the response
+# Periods that get a pause after them: all but a final one (trailing whitespace aside)
+_SENTENCE_END_RE = re.compile(r'\.(?!\s*$)')
+# Finished (noise gated) speech files, by hash of everything that shapes the audio
+TTS_CACHE_DIR = os.path.join(".cache", "tts")
+TTS_CACHE_MAX_BYTES = 512 * 1024 * 1024 # Least recently used files are deleted past this size
 
 load_dotenv()
 
+# One session for every TTS request, so the TLS connection to ElevenLabs is reused.
+# Rate limits and 5xx responses are retried with backoff; the POST is safe to repeat
+# because ElevenLabs only bills requests that return audio.
+http = requests.Session()
+http.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=TTS_CONNECTIONS,
+    max_retries=Retry(
+        total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None, raise_on_status=False
+    )
+))
+atexit.register(http.close)
+
+def chunk_dbfs(audio_segment, chunk_size_ms):
+    """
+    Returns the loudness (dBFS) of every chunk_size_ms window of the audio as a numpy array.
+    Reads the raw samples once instead of slicing a new AudioSegment per chunk.
+    """
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[audio_segment.sample_width]
+    samples = np.frombuffer(audio_segment.raw_data, dtype=dtype).astype(np.float32)
+
+    # Samples per chunk (interleaved channels included), same rounding as pydub slicing
+    spc = int(audio_segment.frame_rate * chunk_size_ms / 1000) * audio_segment.channels
+    n_full = len(samples) // spc
+
+    squares = samples * samples
+    mean_sq = squares[:n_full * spc].reshape(n_full, spc).mean(axis=1)
+    if len(samples) > n_full * spc:
+        # Keep the trailing partial chunk, like the original slicing loop did
+        mean_sq = np.append(mean_sq, squares[n_full * spc:].mean())
+
+    rms = np.sqrt(mean_sq)
+    with np.errstate(divide='ignore'):
+        return 20 * np.log10(rms / audio_segment.max_possible_amplitude)
+
+if njit is not None:
+    # Serial on purpose: the tail is ~20 chunks, and scenes call this from several
+    # threads at once, which Numba's workqueue threading layer aborts on
+    @njit(cache=True)
+    def gate_kernel(samples, spc, threshold_sq):
+        """
+        Fused noise gate pass over int16 samples: measures the mean square of every
+        chunk of spc samples and zeroes it in place when below threshold_sq.
+        Returns the per-chunk boolean mask of silenced chunks.
+        """
+        n_samples = samples.shape[0]
+        n_chunks = (n_samples + spc - 1) // spc
+        is_quiet = np.zeros(n_chunks, dtype=np.bool_)
+        for c in range(n_chunks):
+            start = c * spc
+            end = min(start + spc, n_samples)
+            acc = 0.0
+            for j in range(start, end):
+                v = float(samples[j])
+                acc += v * v
+            if acc / (end - start) < threshold_sq:
+                is_quiet[c] = True
+                for j in range(start, end):
+                    samples[j] = 0
+        return is_quiet
+
+def silence_ranges(is_quiet, chunk_size_ms):
+    """Converts a per-chunk quiet mask into (start_ms, end_ms) runs."""
+    # Runs of quiet chunks start where the padded mask rises and end where it falls
+    edges = np.diff(np.concatenate(([False], is_quiet, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1) * chunk_size_ms
+    ends = np.flatnonzero(edges == -1) * chunk_size_ms
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def decode_mp3(mp3_bytes, frame_rate=44100, channels=1):
+    """
+    Decodes in-memory MP3 bytes to 16-bit PCM and wraps it in an AudioSegment.
+    Uses soundfile when its libsndfile can read MP3, otherwise an ffmpeg pipe.
+    Avoids pydub's from_file, which holds several copies of the decoded audio in memory.
+    ElevenLabs returns 44.1kHz mono, which is why those are the defaults.
+    """
+    if sf is not None:
+        try:
+            samples, rate = sf.read(io.BytesIO(mp3_bytes), dtype='int16', always_2d=True)
+        except RuntimeError as e:
+            # LibsndfileError is a RuntimeError: let ffmpeg try the stream instead
+            print(f"  soundfile could not decode the MP3 ({e}), using ffmpeg.")
+            rate = None
+        # soundfile does not resample, so only take this path when the format already matches
+        if rate == frame_rate and samples.shape[1] == channels:
+            return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=channels)
+
+    command = [
+        AudioSegment.converter, "-v", "error", "-f", "mp3", "-i", "pipe:0",
+        "-f", "s16le", "-acodec", "pcm_s16le",
+        "-ar", str(frame_rate), "-ac", str(channels), "-"
+    ]
+    result = subprocess.run(command, input=mp3_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return AudioSegment(data=result.stdout, sample_width=2, frame_rate=frame_rate, channels=channels)
+
+def encode_mp3(audio_segment, output_path):
+    """
+    Encodes an AudioSegment to an MP3 file by piping its PCM straight into ffmpeg.
+    Same encoder and defaults as AudioSegment.export(format="mp3"), without the
+    temporary WAV and MP3 files pydub writes on the way.
+    """
+    command = [
+        AudioSegment.converter, "-y", "-v", "error",
+        "-f", f"s{audio_segment.sample_width * 8}le",
+        "-ar", str(audio_segment.frame_rate), "-ac", str(audio_segment.channels), "-i", "pipe:0",
+        "-f", "mp3", output_path
+    ]
+    subprocess.run(command, input=audio_segment.raw_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
 def apply_noise_gate(audio_segment, threshold_db=-32.0, chunk_size_ms=10, tail_only_ms=200):
     """
     Applies a simple noise gate to the audio to remove breathing/silence.
     If tail_only_ms is provided, it ONLY applies the gate to the last X milliseconds,
     leaving the rest of the speech completely untouched.
     """
-    # Split audio into the untouched main part and the tail to be processed
+    # Split audio into the untouched main part and the tail to be processed.
+    # Only the tail is copied out; the main part stays in the original buffer.
+    raw = audio_segment.raw_data
     if tail_only_ms > 0 and len(audio_segment) > tail_only_ms:
-        main_audio = audio_segment[:-tail_only_ms]
-        target_audio = audio_segment[-tail_only_ms:]
+        split = int(audio_segment.frame_count(ms=len(audio_segment) - tail_only_ms)) * audio_segment.frame_width
     else:
-        main_audio = audio_segment[:0] # Empty segment
-        target_audio = audio_segment
+        split = 0
+    target_audio = audio_segment._spawn(raw[split:])
         
-    ranges_to_silence = []
-    current_silence_start = None
-    
-    # Scan target audio loudness
-    for i in range(0, len(target_audio), chunk_size_ms):
-        chunk = target_audio[i:i+chunk_size_ms]
+    if njit is not None and target_audio.sample_width == 2:
+        # Measure and silence each chunk in a single compiled pass, writing into buf
+        buf = bytearray(target_audio.raw_data)
+        spc = int(target_audio.frame_rate * chunk_size_ms / 1000) * target_audio.channels
+        threshold_sq = (target_audio.max_possible_amplitude * 10 ** (threshold_db / 20)) ** 2
+        is_quiet = gate_kernel(np.frombuffer(buf, dtype=np.int16), spc, threshold_sq)
+        ranges_to_silence = silence_ranges(is_quiet, chunk_size_ms)
+    else:
+        # Scan target audio loudness (one vectorized pass over the samples)
+        is_quiet = chunk_dbfs(target_audio, chunk_size_ms) < threshold_db
+        ranges_to_silence = silence_ranges(is_quiet, chunk_size_ms)
         
-        if chunk.dBFS < threshold_db:
-            if current_silence_start is None:
-                current_silence_start = i
-        else:
-            if current_silence_start is not None:
-                ranges_to_silence.append((current_silence_start, i))
-                current_silence_start = None
-                
-    # Handle end of file
-    if current_silence_start is not None:
-        ranges_to_silence.append((current_silence_start, len(target_audio)))
+        if is_quiet.all():
+            # Nothing is above the threshold: start from zeros instead of copying the samples
+            buf = bytearray(len(target_audio.raw_data))
+        elif ranges_to_silence:
+            # Zero the breathy sections in a single mutable copy of the samples
+            # instead of rebuilding the whole segment once per range
+            buf = bytearray(target_audio.raw_data)
+            frame_width = target_audio.frame_width
+            frame_rate = target_audio.frame_rate
+            
+            for start, end in ranges_to_silence:
+                # Removed the 'if duration < 50' check here so it successfully processes small tails
+                b0 = int(start * frame_rate / 1000) * frame_width
+                b1 = min(int(end * frame_rate / 1000) * frame_width, len(buf))
+                buf[b0:b1] = bytes(b1 - b0)
         
     if not ranges_to_silence:
         return audio_segment # Return original if no silence found
         
     print(f"    -> Noise Gate: Detected {len(ranges_to_silence)} breath/silence segments in the last {tail_only_ms}ms.")
     
-    cleaned_target = target_audio
-    
-    # Process in reverse order to maintain indices while constructing new audio
-    for start, end in ranges_to_silence[::-1]:
-        duration = end - start
-        # Removed the 'if duration < 50' check here so it successfully processes small tails
-            
-        silence_chunk = AudioSegment.silent(duration=duration)
-        
-        # Replace the breathy section with pure silence
-        cleaned_target = cleaned_target[:start] + silence_chunk + cleaned_target[end:]
-        
-    # Reattach the untouched main audio with the cleaned tail
-    return main_audio + cleaned_target
+    # Reattach the untouched main audio with the cleaned tail in a single copy
+    return audio_segment._spawn(b"".join((memoryview(raw)[:split], buf)))
+
+def store_tts_cache(source_path, cache_path):
+    """
+    Copies a finished speech file into the cache. The copy is written to a temp file
+    and renamed into place, so a crash never leaves a truncated MP3 behind for later runs.
+    """
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=TTS_CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f, open(source_path, 'rb') as src:
+            shutil.copyfileobj(src, f)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def prune_tts_cache(max_bytes=TTS_CACHE_MAX_BYTES):
+    """Deletes the least recently used cached speech files until the cache fits in max_bytes."""
+    # Only finished entries: temp files still being written are left alone
+    entries = [entry for entry in os.scandir(TTS_CACHE_DIR) if entry.name.endswith(".mp3")]
+    # Cache hits touch their file, so the newest mtimes are the most recently used
+    stats = []
+    for entry in entries:
+        try:
+            stats.append((entry.path, entry.stat()))
+        except FileNotFoundError:
+            pass # Pruned by another scene's thread since the listing
+    stats.sort(key=lambda item: item[1].st_mtime, reverse=True)
+    total = 0
+    for path, stat in stats:
+        total += stat.st_size
+        if total > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Already pruned by another thread
 
 def generate_speech(
     text, 
@@ -71,7 +246,8 @@ def generate_speech(
     voice_id=DEFAULT_VOICE_ID,
     title_pause=1.0,
     sentence_pause=0.2,
-    noise_gate_threshold=-38.0
+    noise_gate_threshold=-38.0,
+    use_cache=True
 ):
     """
     Generates Italian speech using ElevenLabs, then applies a noise gate 
@@ -85,6 +261,8 @@ def generate_speech(
         title_pause (float): Seconds of silence after the first line.
         sentence_pause (float): Seconds of silence after each period.
         noise_gate_threshold (float): dB threshold for removing breath sounds.
+        use_cache (bool): Reuse speech cached by an earlier identical request. Pass False
+            to force a new generation (the new audio still replaces the cached one).
     """
     # 1. Get API Key
     key = api_key or os.environ.get("ELEVENLABS_API_KEY")
@@ -98,12 +276,8 @@ def generate_speech(
     break_tag = f" <break time=\"{sentence_pause}s\" />"
 
     def add_breaks(segment):
-        # Replace all periods with period + break
-        processed = segment.replace(".", "." + break_tag)
-        # Remove the break if it's at the very end of the string (ignoring whitespace)
-        if processed.rstrip().endswith(break_tag.strip()):
-            processed = processed[:processed.rfind(break_tag)]
-        return processed
+        # Add a break after every period, except at the very end of the string
+        return _SENTENCE_END_RE.sub(lambda m: "." + break_tag, segment)
 
     # Treat the first line as the "Header/Title"
     parts = text.strip().split('\n', 1)
@@ -137,39 +311,55 @@ def generate_speech(
         }
     }
 
+    # 4. Same request as an earlier run: reuse its audio instead of calling the API
+    request_key = json.dumps([voice_id, data, noise_gate_threshold], sort_keys=True)
+    cache_path = os.path.join(TTS_CACHE_DIR, hashlib.sha256(request_key.encode('utf-8')).hexdigest() + ".mp3")
+    if use_cache:
+        try:
+            shutil.copyfile(cache_path, output_path)
+            os.utime(cache_path) # Mark it as recently used for prune_tts_cache
+            print(f"  Same speech already generated, copied to: {output_path}")
+            return True
+        except OSError:
+            pass # Not cached yet (or already evicted, or the cache is unreadable)
+
     try:
-        # 4. Call API
-        response = requests.post(url, json=data, headers=headers)
+        # 5. Call API
+        response = http.post(url, json=data, headers=headers, timeout=TTS_TIMEOUT)
         
         if response.status_code == 200:
-            # 5. Save Audio to Temp File
-            temp_path = f"temp_{os.path.basename(output_path)}"
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            
-            # 6. Apply Noise Gate
+            # 6. Apply Noise Gate, decoding the MP3 straight from the response body
             try:
                 print(f"  Applying noise gate to last 200ms (Threshold: {noise_gate_threshold}dB)...")
-                audio = AudioSegment.from_mp3(temp_path)
+                audio = decode_mp3(response.content)
                 # Call apply_noise_gate (it defaults to 50ms now)
                 cleaned = apply_noise_gate(audio, threshold_db=noise_gate_threshold)
                 
-                # 7. Export Cleaned Audio
-                cleaned.export(output_path, format="mp3")
-                print(f"  Audio cleaned and saved to: {output_path}")
+                # 7. Export Cleaned Audio (apply_noise_gate returns its input when nothing was gated)
+                if cleaned is audio:
+                    # Keep the original MP3 bytes instead of re-encoding unchanged samples
+                    with open(output_path, 'wb') as f:
+                        f.write(response.content)
+                    print(f"  No breath sounds found, original audio saved to: {output_path}")
+                else:
+                    encode_mp3(cleaned, output_path)
+                    print(f"  Audio cleaned and saved to: {output_path}")
                 
             except Exception as e:
                 print(f"  Error during noise gate processing: {e}")
-                # Fallback: Rename temp to output if pydub fails
-                if os.path.exists(temp_path):
-                    os.rename(temp_path, output_path)
-                    print("  Saved original audio (uncleaned) due to error.")
+                # Fallback: Save the original audio if decoding or gating fails
+                with open(output_path, 'wb') as f:
+                    f.write(response.content)
+                print("  Saved original audio (uncleaned) due to error.")
+                return True
+            
+            # 8. Cache the cleaned audio; a cache failure must not touch output_path
+            try:
+                store_tts_cache(output_path, cache_path)
+                prune_tts_cache()
+            except OSError as e:
+                print(f"  Warning: could not cache the speech: {e}")
             
-            # 8. Cleanup Temp File
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
             return True
 
         else: